@@ -0,0 +1,290 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import tracemalloc
+import pandas as pd
+
+# Run from the benchmarks folder: python benchmark.py
+# Every stage runs in a temporary copy of the folder layout, so the real data folders are not touched
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for folder in ('data_collection', 'data_processing', 'ui'):
+    sys.path.insert(0, os.path.join(ROOT_DIR, folder))
+
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import collect_data
+import process_data
+import app
+from corr_index import get_checkpoints_filename
+from fake_client import FakeEntsoePandasClient, synthetic_prices
+
+# Global variables
+
+COUNTRIES = ['FR', 'NL', 'BE', 'HU', 'RO', 'DE', 'AT', 'CZ', 'PL', 'SK', 'SI', 'HR', 'ES', 'PT', 'IT', 'DK']
+N_COUNTRIES = int(os.environ.get('BENCHMARK_COUNTRIES', 5)) # Number of synthetic countries
+YEARS = int(os.environ.get('BENCHMARK_YEARS', 2)) # Length of the synthetic dataset
+FREQ = os.environ.get('BENCHMARK_FREQ', 'h') # 'h' or '15min'
+GAP_FRACTION = 0.01 # Share of the days without prices
+TIME_ZONE = 'Europe/Brussels' # The fake client answers in local time like ENTSO-E, with the DST transitions
+SEED = 0
+START_DATE = '2020-01-01'
+
+SWEEP_WORKERS = [int(n) for n in os.environ.get('BENCHMARK_WORKERS', '1,2,4').split(',')] # PARALLEL_WORKERS of the derived columns stages, 1 = serial
+REPEAT = int(os.environ.get('BENCHMARK_REPEAT', 3)) # Timed runs per stage, the fastest one is reported
+TOLERANCE = 0.2 # A stage is a regression when it is this much slower or bigger than the baseline
+MIN_SECONDS = 0.05 # Smaller time differences are noise
+RESULTS_FOLDER = os.path.join(ROOT_DIR, 'benchmarks', 'results')
+BASELINE_FILENAME = os.path.join(RESULTS_FOLDER, 'baseline.json') # Delete it to take the next run as the baseline
+
+# Helper functions
+
+def get_countries():
+    return COUNTRIES[:N_COUNTRIES]
+
+def get_end_date():
+    return (pd.Timestamp(START_DATE) + pd.DateOffset(years=YEARS)).strftime('%Y-%m-%d')
+
+def get_config():
+    return {'countries': N_COUNTRIES, 'years': YEARS, 'freq': FREQ, 'gap_fraction': GAP_FRACTION,
+            'time_zone': TIME_ZONE, 'seed': SEED, 'storage_backend': process_data.STORAGE_BACKEND, 'workers': SWEEP_WORKERS}
+
+def create_workspace():
+    workspace = tempfile.mkdtemp(prefix='benchmark_')
+    for folder in ('data_collection/data', 'data_processing/data', 'ui'):
+        os.makedirs(os.path.join(workspace, folder))
+    return workspace
+
+def measure(func, setup=None, repeat=REPEAT):
+    # Fastest of the timed runs, then one more run for the peak of the Python allocations (numpy included)
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'seconds': min(times), 'peak_mb': peak / 2**20}
+
+def remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+class HeadlessCanvas(FigureCanvasAgg):
+    # Stands in for FigureCanvasTkAgg in show_figure
+    def get_tk_widget(self):
+        return self
+
+    def grid(self, **kwargs):
+        pass
+
+# Stages
+
+def get_stages(workspace):
+    # The scripts find their files in the workspace instead of the project folder
+    for module in (collect_data, process_data, app):
+        module.ROOT_DIR = workspace
+    countries = get_countries()
+    start_tz, end_tz = pd.Timestamp(START_DATE, tz='UTC'), pd.Timestamp(get_end_date(), tz='UTC')
+    client = FakeEntsoePandasClient(seed=SEED, freq=FREQ, gap_fraction=GAP_FRACTION, tz=TIME_ZONE)
+    in_filename = collect_data.get_filename(countries, START_DATE, get_end_date())
+    process_data.IN_FILENAME = in_filename
+
+    collection_file = os.path.join(workspace, 'data_collection', in_filename)
+    out_filename = os.path.join(workspace, 'data_processing', 'data', 'final.sqlite')
+    out_path = process_data.get_parquet_folder(out_filename) if process_data.STORAGE_BACKEND == 'parquet' else out_filename
+    state = {}
+
+    def generate():
+        return [synthetic_prices(country, start_tz, end_tz, SEED, FREQ, GAP_FRACTION, TIME_ZONE) for country in countries]
+
+    def remove_collection():
+        remove_path(collection_file)
+        remove_path(collect_data.get_parquet_folder(collection_file))
+
+    def collect():
+        collect_data.download_data(client, countries, START_DATE, get_end_date(), requests_per_second=None)
+
+    def remove_output():
+        corr_index_filename = process_data.get_corr_index_filename(out_path)
+        for path in (out_path, process_data.get_catalog_filename(out_path), corr_index_filename, get_checkpoints_filename(corr_index_filename)):
+            remove_path(path)
+
+    def process():
+        process_data.main()
+
+    def read_input():
+        if 'input' not in state:
+            state['input'] = process_data.preprocess_data(process_data.get_input_data(collection_file))
+
+    def derived_columns(workers):
+        # The derived columns of the whole input with PARALLEL_WORKERS workers, without reading and saving
+        def run():
+            parallel_workers = process_data.PARALLEL_WORKERS
+            process_data.PARALLEL_WORKERS = workers
+            try:
+                process_data.process_all_data(state['input'], process_data.get_country_codes(state['input']))
+            finally:
+                process_data.PARALLEL_WORKERS = parallel_workers
+        return run
+
+    def read_output():
+        state['df'] = pd.concat(list(process_data.iter_processed_chunks(out_path, process_data.CHUNK_BLOCKS * process_data.BLOCK_ROWS)))
+
+    def write_output():
+        copy_filename = os.path.join(workspace, 'data_processing', 'data', 'copy.sqlite')
+        if process_data.STORAGE_BACKEND == 'parquet':
+            copy_filename = process_data.get_parquet_folder(copy_filename)
+        process_data.save_output({'df': state['df']}, copy_filename)
+
+    def correlation():
+        process_data.correlation_matrix(state['df'])
+
+    def corr_index():
+        state['corr_index'] = process_data.update_corr_index(None, state['df'])
+
+    def corr_range():
+        start = state['df'].index[len(state['df']) // 3]
+        state['corr_index'].corr(countries[:3], start, start + pd.Timedelta(days=90), lambda columns, s, e: state['df'].loc[s:e, columns])
+
+    def setup_ui():
+        app.PARQUET_FOLDER = out_path if process_data.STORAGE_BACKEND == 'parquet' else None
+        app.SQLITE_FILE = out_filename
+        catalog = app.read_catalog(out_path)
+        app.SAVED_DTYPES.update(catalog.get('dtypes', {}))
+        # every timed plot reads its data, not the result of the previous run
+        app.QUERY_CACHE.clear()
+        fig = Figure(figsize=(8, 5))
+        app.AX_DF = fig.add_subplot(111)
+        app.CANVAS_DF = HeadlessCanvas(fig)
+        app.DF_Y_COLS = [countries[0], f"{countries[0]}_7d_MA", f"{countries[-1]}_daily_volatility"]
+        state['last'] = pd.Timestamp(catalog['last'])
+
+    def ui_slice_week():
+        app.get_frame(app.DF_Y_COLS, state['last'] - pd.Timedelta(days=7), state['last'])
+
+    def ui_slice_year():
+        app.get_frame(app.DF_Y_COLS, state['last'] - pd.Timedelta(days=365), state['last'])
+
+    def ui_plot(days):
+        def plot():
+            app.START, app.END = state['last'] - pd.Timedelta(days=days), state['last']
+            app.show_figure()
+        return plot
+
+    # (name, function, setup), the stages run in this order
+    return [
+        ('generate', generate, None),
+        ('collect', collect, remove_collection),
+        ('process', process, remove_output),
+        *[(f"derived_workers_{workers}", derived_columns(workers), read_input) for workers in SWEEP_WORKERS],
+        ('storage_read', read_output, None),
+        ('storage_write', write_output, None),
+        ('correlation_matrix', correlation, None),
+        ('corr_index_build', corr_index, None),
+        ('corr_index_query', corr_range, None),
+        ('ui_slice_week', ui_slice_week, setup_ui),
+        ('ui_slice_year', ui_slice_year, setup_ui),
+        ('ui_plot_week', ui_plot(7), setup_ui),
+        ('ui_plot_all', ui_plot(YEARS * 366), setup_ui),
+    ]
+
+# Results
+
+def save_results(results, filename):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'w') as f:
+        json.dump(results, f, indent=2)
+
+def read_results(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def compare(results, baseline):
+    # returns the regressed stages
+    regressions = []
+    print(f"{'stage':<20} {'seconds':>9} {'baseline':>9} {'peak MB':>9} {'baseline':>9}")
+    for name, stage in results['stages'].items():
+        base = baseline['stages'].get(name)
+        if base is None:
+            print(f"{name:<20} {stage['seconds']:9.3f} {'-':>9} {stage['peak_mb']:9.1f} {'-':>9}")
+            continue
+        slower = stage['seconds'] > base['seconds'] * (1 + TOLERANCE) and stage['seconds'] - base['seconds'] > MIN_SECONDS
+        bigger = stage['peak_mb'] > base['peak_mb'] * (1 + TOLERANCE) and stage['peak_mb'] - base['peak_mb'] > 1
+        flag = ' REGRESSION' if slower or bigger else ''
+        print(f"{name:<20} {stage['seconds']:9.3f} {base['seconds']:9.3f} {stage['peak_mb']:9.1f} {base['peak_mb']:9.1f}{flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+def print_speedups(results):
+    # Wall time of the derived columns by the number of workers, compared to the serial processing
+    serial = results['stages'].get('derived_workers_1')
+    if serial is None:
+        return
+    print(f"{'workers':<8} {'seconds':>9} {'speedup':>8} {'efficiency':>10}")
+    for workers in SWEEP_WORKERS:
+        seconds = results['stages'][f"derived_workers_{workers}"]['seconds']
+        speedup = serial['seconds'] / seconds
+        print(f"{workers:<8} {seconds:9.3f} {speedup:7.2f}x {speedup / workers:10.0%}")
+    print(f"({os.cpu_count()} CPUs)")
+
+# Main code
+
+def main():
+    workspace = create_workspace()
+    results = {'config': get_config(), 'python': platform.python_version(), 'machine': platform.platform(),
+               'created': pd.Timestamp.now(tz='UTC').isoformat(), 'stages': {}}
+    try:
+        for name, func, setup in get_stages(workspace):
+            print(f"Running {name}...")
+            results['stages'][name] = measure(func, setup)
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    filename = os.path.join(RESULTS_FOLDER, f"{pd.Timestamp.now():%Y%m%d-%H%M%S}.json")
+    save_results(results, filename)
+    print(f"Results saved in {filename}")
+
+    baseline = read_results(BASELINE_FILENAME)
+    if baseline is None:
+        print_speedups(results)
+        save_results(results, BASELINE_FILENAME)
+        print(f"Saved as the baseline in {BASELINE_FILENAME}")
+        return 0
+    if baseline['config'] != results['config']:
+        print_speedups(results)
+        print("The baseline was made with a different configuration, it is not compared.")
+        return 0
+
+    print_speedups(results)
+    regressions = compare(results, baseline)
+    if regressions:
+        print(f"Slower or bigger than the baseline: {', '.join(regressions)}")
+        return 1
+    print("No regressions.")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
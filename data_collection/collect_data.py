@@ -1,8 +1,33 @@
 import os
+import sys
+import json
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from entsoe import EntsoePandasClient
 import pandas as pd
 
-from sqlalchemy import create_engine
+from fake_client import FakeEntsoePandasClient
+from transport import ResponseCache, CachingClient
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+from instrumentation import traced
+
+from sqlalchemy import create_engine, inspect, text
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+try:
+    import requests # Installed with entsoe-py, its errors tell which requests are worth retrying
+except ImportError:
+    requests = None
 
 # Global variables
 
@@ -10,6 +35,29 @@ COUNTY_CODES = ['FR', 'NL', 'BE', 'HU', 'RO'] # List of country codes to collect
 START_DATE = '2020-01-01' # Start date for data collection (00:00 UTC)
 END_DATE = '2020-03-01' # End date for data collection (00:00 UTC)
 
+MAX_WORKERS = 4 # Number of parallel download threads (1 = sequential)
+REQUESTS_PER_SECOND = 2.0 # Upper limit for requests sent to ENTSO-E (None = no limit)
+MAX_RETRIES = 3 # Number of retries after a failed request
+BACKOFF_SECONDS = 1.0 # First retry waits this long, then doubles every time
+CHUNK_FREQ = 'MS' # Split the date range into chunks ('MS' = monthly), every finished chunk is saved right away. None = one request per country
+
+INCREMENTAL = False # Collect into one growing dataset and only download the missing date ranges
+DATASET_FILENAME = 'data/prices.sqlite' # File of the growing dataset
+PRICES_TABLE = 'prices' # View of the hourly prices, one column per country
+PRICES_LONG_TABLE = 'prices_long' # Table of the hourly prices, one (country, Datetime, price) row per value
+COUNTRIES_TABLE = 'countries' # Table of the country codes that have prices, used to build the view
+RANGES_TABLE = 'collected_ranges' # Table of the already collected (country, start, end) ranges
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f' # Same text format as pandas to_sql uses in SQLite
+
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sqlite') # 'sqlite' or 'parquet' (partitioned by country and month, needs pyarrow)
+
+# Transport: 'live' = ENTSO-E API, 'record' = ENTSO-E API through the response cache,
+# 'replay' = only the response cache (no network), 'fake' = synthetic prices through the response cache
+TRANSPORT = os.environ.get('ENTSOE_TRANSPORT', 'live')
+CACHE_FOLDER = 'data/cache' # Folder of the cached responses
+CACHE_TTL_SECONDS = None # Cached responses expire after this many seconds (None = never)
+CACHE_MAX_MB = 500 # Least recently used responses are dropped above this size (None = no limit)
+
 # Helper functions
 
 def get_api_key():
@@ -25,26 +73,40 @@ def get_api_key():
  
     return API_KEY
 
-def get_client(api_key):
+def get_client(api_key, transport=TRANSPORT):
     try: 
-        client = EntsoePandasClient(api_key)
+        if transport == 'live':
+            client = EntsoePandasClient(api_key)
+        else:
+            max_bytes = CACHE_MAX_MB * 1024 * 1024 if CACHE_MAX_MB is not None else None
+            cache = ResponseCache(get_path('data_collection', CACHE_FOLDER), ttl=CACHE_TTL_SECONDS, max_bytes=max_bytes)
+            if transport == 'record':
+                client = CachingClient(EntsoePandasClient(api_key), cache, mode='record')
+            elif transport == 'replay':
+                client = CachingClient(None, cache, mode='replay')
+            elif transport == 'fake':
+                client = CachingClient(FakeEntsoePandasClient(), cache, mode='record')
+            else:
+                raise ValueError(f'Unknown transport: {transport}')
     except Exception as e:
         print(f"Error in get_client: {e}")
         return None
     print(client)
     return client
 
+def get_path(foldername, filename):
+    # A file in one of the project's folders, the collection writes there from any working directory
+    full_filename = os.path.join(ROOT_DIR, foldername, filename)
+    full_filename = full_filename.replace('\\', '/')
+    full_filename = full_filename[0].upper() + full_filename[1:]
+
+    return full_filename
+
 def get_filename(country_codes = COUNTY_CODES, start_date=START_DATE, end_date=END_DATE):
+    # Relative to the data_collection folder, the processing reads its input by this name
     #put the country codes in a string
     country_codes = '-'.join(country_codes)
-    running_dir = os.getcwd()
-    parent_dir = os.path.dirname(running_dir)
-
     filename = f"data/{country_codes}_{start_date}_{end_date}.sqlite"
-
-    full_path = os.path.join(parent_dir, 'data_collection', filename)
-    full_path = full_path.replace('\\', '/')
-    
     return filename
 
 def create_folder(filename):
@@ -66,15 +128,35 @@ def get_engine(filename):
         return None
     return engine
 
+def get_date_chunks(start_tz, end_tz, freq=CHUNK_FREQ):
+    # Split [start_tz, end_tz) into consecutive (start, end) pairs on the freq boundaries
+    if freq is None:
+        return [(start_tz, end_tz)]
+
+    bounds = pd.date_range(start_tz, end_tz, freq=freq)
+    bounds = [start_tz] + [b for b in bounds if start_tz < b < end_tz] + [end_tz]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+class RateLimiter:
+    # Spaces out the requests of all threads to at most `rate` per second
+    def __init__(self, rate=REQUESTS_PER_SECOND):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
 # Main functions
 
+@traced()
 def run_querry(country_code, client, start_tz, end_tz):
-    try:
-        df = client.query_day_ahead_prices(country_code, start=start_tz, end=end_tz)        # Data from ENTSO-E
-    except Exception as e:
-        print(f"Error: {e}")
-        return None
-    
+    df = client.query_day_ahead_prices(country_code, start=start_tz, end=end_tz)        # Data from ENTSO-E
     df = df.to_frame()
 
     df = df.rename(columns={0: country_code})
@@ -83,60 +165,342 @@ def run_querry(country_code, client, start_tz, end_tz):
 
     return df
 
-def save_data(df, filename):
+def is_transient(error):
+    # Connection problems, timeouts, the rate limit and the server errors can pass. The other errors (no data
+    # for the range, bad parameters, a response missing from the replay cache) come back the same way every time
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    if requests is not None and isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status is not None and (status == 429 or status >= 500)
+
+def run_querry_with_retries(country_code, client, start_tz, end_tz, rate_limiter=None, max_retries=MAX_RETRIES, backoff=BACKOFF_SECONDS):
+    # returns None if the request failed, after the retries for a transient error
+    for attempt in range(max_retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.wait()
+
+        try:
+            return run_querry(country_code, client, start_tz, end_tz)
+        except Exception as e:
+            if not is_transient(e) or attempt == max_retries:
+                print(f"Error: {country_code} ({start_tz} - {end_tz}): {e}")
+                return None
+            wait_time = backoff * 2 ** attempt
+            print(f"Retrying {country_code} ({start_tz} - {end_tz}) in {wait_time} s after: {e}")
+            time.sleep(wait_time)
+
+def download_tasks(client, tasks, max_workers=MAX_WORKERS, requests_per_second=REQUESTS_PER_SECOND, max_retries=MAX_RETRIES):
+    # Download (country, start, end) tasks in a thread pool
+    # yields (task, df) in the order the downloads finish, df is None if the task failed
+    rate_limiter = RateLimiter(requests_per_second)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
     try:
-        engine = get_engine(filename)
-        df.to_sql(filename, engine, if_exists='replace', index=False)       # Save data to SQLite database
-    except Exception as e:
-        print(f"Error: {e}")
+        futures = {executor.submit(run_querry_with_retries, country_code, client, chunk_start, chunk_end, rate_limiter, max_retries): (country_code, chunk_start, chunk_end)
+                   for country_code, chunk_start, chunk_end in tasks}
+
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        # on interruption don't start the remaining downloads
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def report_failures(failures):
+    for country_code, chunks in failures.items():
+        for chunk_start, chunk_end in chunks:
+            print(f"Failed to collect {country_code} between {chunk_start} and {chunk_end}")
+
+# Incremental collection
+
+def to_utc_text(timestamps):
+    timestamps = pd.to_datetime(pd.Series(timestamps), utc=True)
+    return timestamps.dt.tz_convert(None).dt.strftime(DATETIME_FORMAT).tolist()
+
+def create_tables(engine):
+    with engine.begin() as conn:
+        conn.execute(text(f'CREATE TABLE IF NOT EXISTS "{PRICES_LONG_TABLE}" ("Datetime" TIMESTAMP NOT NULL, "country" TEXT NOT NULL, "price" FLOAT, '
+                          f'PRIMARY KEY ("Datetime", "country")) WITHOUT ROWID'))
+        conn.execute(text(f'CREATE TABLE IF NOT EXISTS "{COUNTRIES_TABLE}" ("country" TEXT PRIMARY KEY)'))
+        conn.execute(text(f'CREATE TABLE IF NOT EXISTS "{RANGES_TABLE}" ("country" TEXT, "start" TIMESTAMP, "end" TIMESTAMP)'))
+        create_wide_view(conn)
+
+def create_wide_view(conn):
+    # Pivot the long table to one column per country in a single GROUP BY pass. The columns are sorted by name,
+    # so their order doesn't depend on which download finished first (and is the same as in the parquet backend)
+    countries = [row[0] for row in conn.execute(text(f'SELECT "country" FROM "{COUNTRIES_TABLE}" ORDER BY "country"')).fetchall()]
+    columns = ''.join(f', MAX(CASE WHEN "country" = \'{country}\' THEN "price" END) AS "{country}"' for country in countries)
+
+    conn.execute(text(f'DROP VIEW IF EXISTS "{PRICES_TABLE}"'))
+    conn.execute(text(f'CREATE VIEW "{PRICES_TABLE}" AS SELECT "Datetime"{columns} FROM "{PRICES_LONG_TABLE}" GROUP BY "Datetime"'))
+
+def get_collected_ranges(engine, country_code):
+    with engine.connect() as conn:
+        rows = conn.execute(text(f'SELECT "start", "end" FROM "{RANGES_TABLE}" WHERE "country" = :country ORDER BY "start"'),
+                            {'country': country_code}).fetchall()
+    return [(pd.Timestamp(start, tz='UTC'), pd.Timestamp(end, tz='UTC')) for start, end in rows]
+
+def find_gaps(start_tz, end_tz, ranges):
+    # Parts of [start_tz, end_tz) that are not covered by the (sorted) ranges
+    gaps = []
+    current = start_tz
+    for range_start, range_end in ranges:
+        if range_end <= current:
+            continue
+        if range_start >= end_tz:
+            break
+        if range_start > current:
+            gaps.append((current, range_start))
+        current = max(current, range_end)
+    if current < end_tz:
+        gaps.append((current, end_tz))
+    return gaps
+
+def merge_ranges(ranges):
+    merged = []
+    for range_start, range_end in sorted(ranges):
+        if merged and range_start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], range_end))
+        else:
+            merged.append((range_start, range_end))
+    return merged
+
+def record_range(conn, country_code, start_tz, end_tz):
+    # Store the new range and merge it with the touching ones, so the table stays small
+    rows = conn.execute(text(f'SELECT "start", "end" FROM "{RANGES_TABLE}" WHERE "country" = :country'),
+                        {'country': country_code}).fetchall()
+    ranges = [(pd.Timestamp(start, tz='UTC'), pd.Timestamp(end, tz='UTC')) for start, end in rows]
+    ranges = merge_ranges(ranges + [(start_tz, end_tz)])
+
+    conn.execute(text(f'DELETE FROM "{RANGES_TABLE}" WHERE "country" = :country'), {'country': country_code})
+    starts = to_utc_text([r[0] for r in ranges])
+    ends = to_utc_text([r[1] for r in ranges])
+    conn.execute(text(f'INSERT INTO "{RANGES_TABLE}" ("country", "start", "end") VALUES (:country, :start, :end)'),
+                 [{'country': country_code, 'start': start, 'end': end} for start, end in zip(starts, ends)])
+
+def upsert_prices(conn, df_country, country_code):
+    # Insert new hours and overwrite the existing ones, a new country is only an append
+    rows = [{'Datetime': dt, 'country': country_code, 'price': None if pd.isna(price) else float(price)}
+            for dt, price in zip(to_utc_text(df_country['Datetime']), df_country[country_code])]
+    conn.execute(text(f'INSERT INTO "{PRICES_LONG_TABLE}" ("Datetime", "country", "price") VALUES (:Datetime, :country, :price) '
+                      f'ON CONFLICT("Datetime", "country") DO UPDATE SET "price" = excluded."price"'),
+                 rows)
+
+    new_country = conn.execute(text(f'INSERT OR IGNORE INTO "{COUNTRIES_TABLE}" ("country") VALUES (:country)'),
+                               {'country': country_code}).rowcount
+    if new_country:
+        create_wide_view(conn)
+
+def count_rows(engine, table_name):
+    with engine.connect() as conn:
+        return conn.execute(text(f'SELECT COUNT(*) FROM "{table_name}"')).scalar()
+
+def count_hours(engine):
+    with engine.connect() as conn:
+        return conn.execute(text(f'SELECT COUNT(DISTINCT "Datetime") FROM "{PRICES_LONG_TABLE}"')).scalar()
+
+# Parquet storage
+
+def get_parquet_folder(filename):
+    # The parquet dataset is stored next to the SQLite file, which keeps the checkpoints
+    return filename.replace('.sqlite', '.parquet')
+
+def check_pyarrow():
+    if pq is None:
+        raise ValueError('The parquet storage backend needs pyarrow, install it with: pip install pyarrow')
+
+def save_parquet_chunk(folder, df_chunk, country_code):
+    # Write the chunk into the country=XX/month=YYYY-MM partitions, merged with the prices already there
+    check_pyarrow()
+    df_chunk = pd.DataFrame({
+        'Datetime': pd.to_datetime(df_chunk['Datetime'], utc=True).dt.tz_convert(None),
+        'price': df_chunk[country_code].astype('float64'),
+    })
+    months = df_chunk['Datetime'].dt.strftime('%Y-%m')
+
+    for month, df_month in df_chunk.groupby(months):
+        partition = os.path.join(folder, f'country={country_code}', f'month={month}')
+        os.makedirs(partition, exist_ok=True)
+        path = os.path.join(partition, 'part-0.parquet')
+        if os.path.exists(path):
+            df_old = pq.read_table(path).to_pandas()
+            df_month = pd.concat([df_old, df_month]).drop_duplicates(subset='Datetime', keep='last')
+        df_month = df_month.sort_values('Datetime').reset_index(drop=True)
+
+        tmp_path = path + '.tmp'
+        pq.write_table(pa.Table.from_pandas(df_month, preserve_index=False), tmp_path)
+        os.replace(tmp_path, path)
+
+def count_hours_parquet(folder):
+    check_pyarrow()
+    if not os.path.exists(folder):
+        return 0
+    table = pq.read_table(folder, columns=['Datetime'], memory_map=True)
+    return len(table.column('Datetime').unique())
+
+@traced()
+def save_chunk(engine, country_code, chunk_start, chunk_end, df_chunk, parquet_folder=None):
+    # Save one downloaded chunk and its checkpoint record in the same transaction
+    if df_chunk.empty:
+        return
+    if parquet_folder is not None:
+        # written before the checkpoint, so a crash in between only means downloading the chunk again
+        save_parquet_chunk(parquet_folder, df_chunk, country_code)
+    with engine.begin() as conn:
+        if parquet_folder is None:
+            upsert_prices(conn, df_chunk, country_code)
+        record_range(conn, country_code, chunk_start, get_collected_end(df_chunk['Datetime'], chunk_end))
+
+def get_collected_end(datetimes, chunk_end):
+    # The end of the last delivered interval, so the intervals after the last published price are not marked as collected.
+    # The length of an interval (an hour or 15 minutes) is the smallest step between the prices, a complete response ends at chunk_end
+    times = pd.DatetimeIndex(pd.to_datetime(datetimes, utc=True)).unique().sort_values()
+    if len(times) < 2:
+        # the frequency of a single price is unknown, it is downloaded again with the rest of the chunk
+        return min(chunk_end, times[-1])
+    return min(chunk_end, times[-1] + (times[1:] - times[:-1]).min())
+
+# Catalog
+
+def get_catalog_filename(filename):
+    # Small JSON file next to the dataset, so the row counts, dates and columns can be read without loading the data
+    return f"{filename}.catalog.json"
+
+def hash_path(path):
+    # Content hash of a file or of every file in a folder
+    sha = hashlib.sha256()
+    if os.path.isdir(path):
+        paths = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names if not name.endswith('.tmp'))
+    else:
+        paths = [path]
+    for file_path in paths:
+        sha.update(os.path.relpath(file_path, path).encode())
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+def get_country_stats(engine, parquet_folder=None):
+    # (country, rows, first, last) with one aggregate query instead of reading the table
+    if parquet_folder is not None:
+        check_pyarrow()
+        df = pq.read_table(parquet_folder, columns=['country', 'Datetime', 'price'], memory_map=True).to_pandas()
+        df['country'] = df['country'].astype(str)
+        stats = df.groupby('country').agg(rows=('price', 'count'), first=('Datetime', 'min'), last=('Datetime', 'max'))
+        return [(country, int(row['rows']), str(row['first']), str(row['last'])) for country, row in stats.iterrows()]
+
+    with engine.connect() as conn:
+        rows = conn.execute(text(f'SELECT "country", COUNT("price"), MIN("Datetime"), MAX("Datetime") FROM "{PRICES_LONG_TABLE}" GROUP BY "country"')).fetchall()
+    return [(country, count, str(pd.Timestamp(first)), str(pd.Timestamp(last))) for country, count, first, last in rows]
+
+@traced()
+def write_catalog(filename, engine, parquet_folder=None):
+    stats = get_country_stats(engine, parquet_folder)
+    catalog = {
+        'rows': count_hours_parquet(parquet_folder) if parquet_folder else count_hours(engine),
+        'first': min((first for _, _, first, _ in stats), default=None),
+        'last': max((last for _, _, _, last in stats), default=None),
+        'columns': ['Datetime'] + [country for country, _, _, _ in stats],
+        'countries': {country: {'rows': count, 'first': first, 'last': last} for country, count, first, last in stats},
+        'hash': hash_path(parquet_folder or filename),
+        'updated': pd.Timestamp.now(tz='UTC').isoformat(),
+    }
+    with open(get_catalog_filename(parquet_folder or filename), 'w') as f:
+        json.dump(catalog, f, indent=2)
+    return catalog
+
+def read_catalog(filename):
+    try:
+        with open(get_catalog_filename(filename)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
         return None
-    
-    return filename
 
 # return num rows
-def download_data(client, country_codes = COUNTY_CODES, start_date= START_DATE, end_date= END_DATE):
-    filename = get_filename(country_codes, start_date, end_date)
+@traced()
+def collect_missing(client, filename, country_codes, start_date, end_date, max_workers=MAX_WORKERS, requests_per_second=REQUESTS_PER_SECOND, chunk_freq=CHUNK_FREQ):
+    # Download the chunks that are not in the collected_ranges table yet,
+    # so an interrupted run continues after the last finished chunk
+    create_folder(filename)
+    engine = get_engine(filename)
+    create_tables(engine)
+    parquet_folder = get_parquet_folder(filename) if STORAGE_BACKEND == 'parquet' else None
+
+    start_tz = pd.Timestamp(start_date, tz='UTC')
+    end_tz = pd.Timestamp(end_date, tz='UTC')
+
+    # Find the missing ranges for each country
+    tasks = []
+    for country_code in country_codes:
+        gaps = find_gaps(start_tz, end_tz, get_collected_ranges(engine, country_code))
+        for gap_start, gap_end in gaps:
+            tasks.extend((country_code, chunk_start, chunk_end) for chunk_start, chunk_end in get_date_chunks(gap_start, gap_end, chunk_freq))
+
+    if not tasks:
+        print(f"Data already collected in {filename}")
+        catalog = read_catalog(parquet_folder or filename)
+        if catalog is None:
+            catalog = write_catalog(filename, engine, parquet_folder)
+        return catalog['rows']
+
+    print(f"Collecting {len(tasks)} missing chunks...")
+    failures = {}
+    for (country_code, chunk_start, chunk_end), df_chunk in download_tasks(client, tasks, max_workers, requests_per_second):
+        if df_chunk is None:
+            failures.setdefault(country_code, []).append((chunk_start, chunk_end))
+            continue
+        save_chunk(engine, country_code, chunk_start, chunk_end, df_chunk, parquet_folder)
+        print(f"Saved {country_code} {chunk_start} - {chunk_end}")
+
+    # The failed chunks stay missing and are retried in the next run
+    catalog = write_catalog(filename, engine, parquet_folder)
+    report_failures(failures)
+    if failures:
+        failed = sum(len(chunks) for chunks in failures.values())
+        print(f"{failed} of {len(tasks)} chunks failed, {catalog['rows']} rows are in {parquet_folder or filename}. Run the script again to retry them.")
+    else:
+        print(f"Data saved in {parquet_folder or filename}")
+    return catalog['rows']
+
+# return num rows
+def download_data_incremental(client, country_codes = COUNTY_CODES, start_date= START_DATE, end_date= END_DATE, filename=DATASET_FILENAME, max_workers=MAX_WORKERS, requests_per_second=REQUESTS_PER_SECOND, chunk_freq=CHUNK_FREQ):
+    return collect_missing(client, filename, country_codes, start_date, end_date, max_workers, requests_per_second, chunk_freq)
+
+def is_legacy_file(filename):
+    # Files from older versions have one table named after the file and no checkpoints
+    if not os.path.exists(filename):
+        return False
+    table_names = inspect(get_engine(filename)).get_table_names()
+    return RANGES_TABLE not in table_names
+
+# return num rows
+def download_data(client, country_codes = COUNTY_CODES, start_date= START_DATE, end_date= END_DATE, max_workers=MAX_WORKERS, requests_per_second=REQUESTS_PER_SECOND, chunk_freq=CHUNK_FREQ):
+    # the table of a legacy file is named after the file's name in the data_collection folder
+    table_name = get_filename(country_codes, start_date, end_date)
+    filename = get_path('data_collection', table_name)
 
     # Check if data already collected
-    if os.path.exists(filename):
+    if is_legacy_file(filename):
         print(f"Data already collected in {filename}")
         try:
             engine = get_engine(filename)
-            df = pd.read_sql(filename, engine)
-            
-            #return num rows
-            return df.index.size
-        
+            return count_rows(engine, table_name)
         except Exception as e:
             print(f"Error: {e}")
             return None
-    else: 
-        create_folder(filename)
-
-    start_tz = pd.Timestamp(START_DATE, tz='UTC')
-    end_tz = pd.Timestamp(END_DATE, tz='UTC')
-
-    # Collect data for each country
-    for country_code in COUNTY_CODES:
-        print(f"Collecting data for {country_code}...")
-        df_country = run_querry(country_code, client, start_tz, end_tz)
-        if country_code == COUNTY_CODES[0]:
-            df = df_country
-        else:
-            df = pd.merge(df, df_country, on='Datetime', how='outer')
 
-    # Save data
-    save_data(df, filename)
-    print(f"Data saved in {filename}")
-
-    return df.index.size
+    return collect_missing(client, filename, country_codes, start_date, end_date, max_workers, requests_per_second, chunk_freq)
 
 # Main code
+@traced()
 def main():
-    api_key = get_api_key()
+    api_key = get_api_key() if TRANSPORT in ('live', 'record') else None
     client = get_client(api_key)
-    print(client)
-    size = download_data(client)
+    if INCREMENTAL:
+        size = download_data_incremental(client, filename=get_path('data_collection', DATASET_FILENAME))
+    else:
+        size = download_data(client)
     print(f'There are {size} rows in the dataset.')
     print("Data collection completed.")
 
@@ -0,0 +1,50 @@
+import time
+import numpy as np
+import pandas as pd
+
+# Offline stand-in for EntsoePandasClient
+
+class FakeEntsoePandasClient:
+    def __init__(self, latency=0.0, fail_countries=None, seed=0, freq='h', gap_fraction=0.0, tz=None):
+        self.latency = latency # Artificial latency per request in seconds
+        self.fail_countries = fail_countries or [] # Country codes that always fail
+        self.seed = seed
+        self.freq = freq # 'h' or '15min'
+        self.gap_fraction = gap_fraction # Share of the days without prices
+        self.tz = tz # Time zone of the returned index, e.g. 'Europe/Brussels' like ENTSO-E (None = as requested)
+        self.calls = 0
+
+    def __repr__(self):
+        return f"FakeEntsoePandasClient(latency={self.latency})"
+
+    def query_day_ahead_prices(self, country_code, start, end):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if country_code in self.fail_countries:
+            raise ConnectionError(f"Fake failure for {country_code}")
+
+        return synthetic_prices(country_code, start, end, seed=self.seed, freq=self.freq,
+                                gap_fraction=self.gap_fraction, tz=self.tz)
+
+def synthetic_prices(country_code, start, end, seed=0, freq='h', gap_fraction=0.0, tz=None):
+    # Prices with a daily cycle, the values only depend on the country and the timestamp,
+    # so the same range gives the same series no matter how it is split into requests
+    index = pd.date_range(start, end, freq=freq, inclusive='left')
+    hours = index.asi8 / 3_600_000_000_000
+
+    offset = sum(ord(c) for c in country_code) + seed
+    base = 40 + offset % 30
+    daily = 15 * np.sin(2 * np.pi * (hours % 24) / 24)
+    noise = np.sin(hours * 0.7 + offset) * 5
+
+    prices = pd.Series(np.round(base + daily + noise, 2), index=index)
+    if gap_fraction:
+        # whole days are missing, like an outage of the data provider
+        days = (hours // 24).astype(np.int64)
+        missing = (days * 2654435761 + offset * 97) % 1000 < gap_fraction * 1000
+        prices = prices[~missing]
+    if tz is not None:
+        # a local time zone has 23 and 25 hour days at the DST transitions
+        prices.index = prices.index.tz_convert(tz)
+    return prices
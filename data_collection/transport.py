@@ -0,0 +1,97 @@
+import os
+import time
+import pickle
+import hashlib
+import threading
+
+# On-disk response cache and record/replay transport for run_querry
+
+DAY_AHEAD_PRICES = 'day_ahead_prices' # Document type of query_day_ahead_prices
+
+class ResponseCache:
+    def __init__(self, folder, ttl=None, max_bytes=None):
+        self.folder = folder # Folder of the cached responses, one pickle file per response
+        self.ttl = ttl # Responses older than this many seconds are dropped (None = never)
+        self.max_bytes = max_bytes # Least recently used responses are dropped above this size (None = no limit)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def get_key(self, country_code, start, end, document_type=DAY_AHEAD_PRICES):
+        key = f"{document_type}|{country_code}|{start.isoformat()}|{end.isoformat()}"
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.folder, f"{key}.pkl")
+
+    def get(self, key):
+        path = self.get_path(key)
+        with self.lock:
+            try:
+                if self.ttl is not None and time.time() - os.path.getmtime(path) > self.ttl:
+                    os.remove(path)
+                    raise FileNotFoundError(path)
+                with open(path, 'rb') as f:
+                    value = pickle.load(f)
+                # mark as recently used for the eviction
+                os.utime(path, (time.time(), os.path.getmtime(path)))
+            except (OSError, pickle.PickleError, EOFError):
+                self.misses += 1
+                return None
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        path = self.get_path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            os.replace(tmp_path, path)
+            self.evict()
+
+    def evict(self):
+        if self.max_bytes is None:
+            return
+        entries = []
+        for name in os.listdir(self.folder):
+            if name.endswith('.pkl'):
+                stat = os.stat(os.path.join(self.folder, name))
+                entries.append((stat.st_atime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.folder, name))
+            total -= size
+
+class CachingClient:
+    # Drop-in replacement of EntsoePandasClient for run_querry
+    # mode 'record': answer from the cache, ask the client on a miss and store the response
+    # mode 'replay': answer only from the cache, a miss is a LookupError (not retried, see is_transient)
+    def __init__(self, client, cache, mode='record'):
+        if mode not in ('record', 'replay'):
+            raise ValueError(f'Unknown cache mode: {mode}')
+        if mode == 'record' and client is None:
+            raise ValueError('The record mode needs a client')
+        self.client = client
+        self.cache = cache
+        self.mode = mode
+
+    def __repr__(self):
+        return f"CachingClient({self.client!r}, mode={self.mode})"
+
+    def query_day_ahead_prices(self, country_code, start, end):
+        key = self.cache.get_key(country_code, start, end, DAY_AHEAD_PRICES)
+        series = self.cache.get(key)
+        if series is not None:
+            return series
+
+        if self.mode == 'replay':
+            raise LookupError(f"No cached response for {country_code} between {start} and {end}")
+
+        series = self.client.query_day_ahead_prices(country_code, start=start, end=end)
+        self.cache.put(key, series)
+        return series
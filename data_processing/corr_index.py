@@ -0,0 +1,154 @@
+import os
+import numpy as np
+import pandas as pd
+
+# Cumulative pairwise sums of the processed columns, the correlation of any columns over any date range
+# is the difference of two checkpoints plus the rows at the edges. A checkpoint is 4 x columns x columns numbers,
+# so the checkpoints are saved in their own file and memory mapped when the index is loaded
+
+def pair_sums(x):
+    # (n, sx, sxx, sxy) of the rows of x, only the rows where both columns have a finite value are counted
+    # (like df.corr(), e.g. the infinite percentage change after a zero price is left out)
+    # [i, j] of sx and sxx: sum of column i where column j has a value
+    finite = np.isfinite(x)
+    mask = finite.astype('float64')
+    x = np.where(finite, x, 0.0)
+    return np.stack([mask.T @ mask, x.T @ mask, (x * x).T @ mask, x.T @ x])
+
+def corr_from_sums(sums, columns):
+    n, sx, sxx, sxy = sums
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = n * sxy - sx * sx.T
+        var_x = n * sxx - sx * sx
+        # a constant column only has rounding errors left of its variance
+        var_x = np.where(var_x > 1e-12 * n * sxx, var_x, 0.0)
+        var_y = var_x.T
+        corr = cov / np.sqrt(var_x * var_y)
+    corr = np.where((var_x > 0) & (var_y > 0), np.clip(corr, -1, 1), np.nan)
+    np.fill_diagonal(corr, np.where(np.diag(var_x) > 0, 1.0, np.nan))
+    return pd.DataFrame(corr, index=list(columns), columns=list(columns))
+
+class CorrIndex:
+    def __init__(self, columns, shift, segment_rows):
+        self.columns = list(columns)
+        self.shift = np.asarray(shift, dtype='float64') # Subtracted from the values, keeps the sums small and precise
+        self.segment_rows = segment_rows # Rows between two checkpoints
+        self.rows = 0
+        self.times = [] # Datetime of the first row of every segment
+        k = len(self.columns)
+        # sums of the rows before every segment: the saved ones (memory mapped) and the ones added since
+        self.saved = np.zeros((0, 4, k, k))
+        self.saved_filename = None
+        self.added = []
+        self.current = np.zeros((4, k, k)) # Sums of the rows of the last segment so far
+        self.last_time = None
+
+    def __repr__(self):
+        return f"CorrIndex({len(self.columns)} columns, {self.rows} rows, {self.checkpoints} segments)"
+
+    @property
+    def checkpoints(self):
+        return len(self.saved) + len(self.added)
+
+    def get_checkpoint(self, i):
+        return self.saved[i] if i < len(self.saved) else self.added[i - len(self.saved)]
+
+    def update(self, datetimes, x):
+        # Add the next rows (in time order) of the columns
+        x = np.asarray(x, dtype='float64') - self.shift
+        datetimes = pd.DatetimeIndex(datetimes)
+        pos = 0
+        while pos < len(x):
+            if self.rows % self.segment_rows == 0:
+                self.added.append(self.get_checkpoint(self.checkpoints - 1) + self.current if self.checkpoints else np.zeros_like(self.current))
+                self.times.append(datetimes[pos])
+                self.current = np.zeros_like(self.current)
+            take = min(self.segment_rows - self.rows % self.segment_rows, len(x) - pos)
+            self.current += pair_sums(x[pos:pos + take])
+            self.rows += take
+            pos += take
+        if len(datetimes):
+            self.last_time = datetimes[-1]
+        return self
+
+    def get_sums(self, checkpoint, idx):
+        # Sums of the rows before the checkpoint (self.checkpoints = all rows) of the columns idx
+        if checkpoint < self.checkpoints:
+            return self.get_checkpoint(checkpoint)[:, idx][:, :, idx]
+        return (self.get_checkpoint(checkpoint - 1) + self.current)[:, idx][:, :, idx]
+
+    def corr(self, columns=None, start=None, end=None, get_frame=None):
+        # Correlation of the columns between start and end (both included)
+        # get_frame(columns, start, end) returns the rows at the edges, it is only needed for a date range
+        columns = self.columns if columns is None else list(columns)
+        idx = [self.columns.index(col) for col in columns]
+        start = pd.Timestamp(start) if start is not None else None
+        end = pd.Timestamp(end) if end is not None else None
+        if not self.checkpoints:
+            return corr_from_sums(np.zeros((4, len(idx), len(idx))), columns)
+
+        # [first, last) are the checkpoints inside the range, the last one is the end of the data
+        times = pd.DatetimeIndex(self.times + [self.last_time + pd.Timedelta(1, 'ns')])
+        first = 0 if start is None else times.searchsorted(start, 'left')
+        last = self.checkpoints if end is None else min(times.searchsorted(end, 'right') - 1, self.checkpoints)
+
+        def edge_sums(edge_start, edge_end):
+            df = get_frame(columns, edge_start, edge_end)
+            return pair_sums(df[columns].to_numpy(dtype='float64') - self.shift[idx])
+
+        if first >= last:
+            return corr_from_sums(edge_sums(start, end), columns)
+
+        sums = self.get_sums(last, idx) - self.get_sums(first, idx)
+        if start is not None and times[first] > start:
+            sums = sums + edge_sums(start, times[first] - pd.Timedelta(1, 'ns'))
+        if last < self.checkpoints:
+            sums = sums + edge_sums(times[last], end)
+        return corr_from_sums(sums, columns)
+
+    def save(self, filename):
+        # The checkpoints of an index loaded from the same file are already saved, only the new ones are appended.
+        # They are written before the other arrays, which have their number, so an interrupted save keeps the old index
+        checkpoints_filename = get_checkpoints_filename(filename)
+        if self.saved_filename == checkpoints_filename:
+            with open(checkpoints_filename, 'r+b') as f:
+                f.truncate(self.saved.nbytes)
+            new = self.added
+        else:
+            open(checkpoints_filename, 'wb').close()
+            new = [self.get_checkpoint(i) for i in range(self.checkpoints)]
+        with open(checkpoints_filename, 'ab') as f:
+            for checkpoint in new:
+                f.write(np.ascontiguousarray(checkpoint, dtype='float64').tobytes())
+
+        np.savez(filename, columns=np.array(self.columns), shift=self.shift, segment_rows=self.segment_rows,
+                 rows=self.rows, times=pd.DatetimeIndex(self.times).asi8, last_time=pd.Timestamp(self.last_time).value,
+                 checkpoints=self.checkpoints, current=self.current)
+        self.saved = map_checkpoints(checkpoints_filename, self.checkpoints, len(self.columns))
+        self.saved_filename = checkpoints_filename
+        self.added = []
+
+def get_checkpoints_filename(filename):
+    return f"{os.path.splitext(filename)[0]}.checkpoints.bin"
+
+def map_checkpoints(filename, count, k):
+    # The checkpoints are only read from the file when a query needs them
+    if count == 0:
+        return np.zeros((0, 4, k, k))
+    return np.memmap(filename, dtype='float64', mode='r', shape=(count, 4, k, k))
+
+def load_corr_index(filename):
+    try:
+        with np.load(filename) as data:
+            index = CorrIndex(data['columns'].tolist(), data['shift'], int(data['segment_rows']))
+            index.rows = int(data['rows'])
+            index.times = list(pd.to_datetime(data['times']))
+            index.current = data['current']
+            index.last_time = pd.Timestamp(int(data['last_time']))
+            count = int(data['checkpoints'])
+        index.saved = map_checkpoints(get_checkpoints_filename(filename), count, len(index.columns))
+        index.saved_filename = get_checkpoints_filename(filename)
+    except (OSError, ValueError, KeyError):
+        # an index saved by an older version (with the checkpoints inside) is built again
+        return None
+    return index
@@ -0,0 +1,182 @@
+import math
+from collections import deque
+import numpy as np
+import pandas as pd
+
+from process_data import FAMILIES, get_metric_columns
+
+# Derived columns of a live price feed, updated point by point in fixed memory. The values are the same
+# as rolling_stats gives for the same rows: the windows count rows (not hours) and skip the missing prices
+
+class RingBuffer:
+    def __init__(self, capacity, width=None, dtype='float64'):
+        self.capacity = capacity # The oldest rows are overwritten above this many rows
+        shape = (capacity,) if width is None else (capacity, width)
+        self.data = np.full(shape, np.nan) if np.dtype(dtype).kind == 'f' else np.zeros(shape, dtype=dtype)
+        self.count = 0 # Number of rows ever appended
+
+    def __repr__(self):
+        return f"RingBuffer({len(self)} of {self.capacity} rows)"
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, row):
+        self.data[self.count % self.capacity] = row
+        self.count += 1
+
+    def get(self, back=0):
+        # The row appended back rows before the last one
+        return self.data[(self.count - 1 - back) % self.capacity]
+
+    def values(self):
+        # The rows in the order they were appended (a copy once the buffer wrapped around)
+        if self.count <= self.capacity:
+            return self.data[:self.count]
+        position = self.count % self.capacity
+        return np.concatenate([self.data[position:], self.data[:position]])
+
+class RollingWindow:
+    # rolling(window, min_periods=1) mean, std, min or max of the values added one by one, O(1) per value
+    # (amortized for min and max). The mean and the variance are running sums of the values in the window
+    # (Welford's update), recomputed from the window every window values so the rounding errors don't add up
+    def __init__(self, window, statistic):
+        if statistic not in ('mean', 'std', 'min', 'max'):
+            raise ValueError(f"Unknown statistic: {statistic}")
+        self.window = window
+        self.statistic = statistic
+        self.values = RingBuffer(window)
+        self.n = 0 # Number of values in the window, without the missing ones
+        self.mean = 0.0
+        self.m2 = 0.0 # Sum of the squared differences from the mean
+        self.extremes = deque() # (position, value) of the candidates of the min or max, the oldest first
+        self.added = 0
+
+    def __repr__(self):
+        return f"RollingWindow({self.window}, '{self.statistic}')"
+
+    def include(self, value):
+        if math.isnan(value):
+            return
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+
+    def exclude(self, value):
+        if math.isnan(value):
+            return
+        self.n -= 1
+        if self.n == 0:
+            self.mean = self.m2 = 0.0
+            return
+        delta = value - self.mean
+        self.mean -= delta / self.n
+        self.m2 -= delta * (value - self.mean)
+
+    def recompute(self):
+        window = self.values.values()
+        window = window[~np.isnan(window)]
+        self.n = len(window)
+        self.mean = float(window.mean()) if self.n else 0.0
+        self.m2 = float(((window - self.mean) ** 2).sum()) if self.n else 0.0
+
+    def add(self, value):
+        # Adds the value and returns the statistic of the window ending with it, an infinite value counts as missing like in pandas
+        value = float(value)
+        if math.isinf(value):
+            value = np.nan
+        position = self.added
+        self.added += 1
+        if self.statistic in ('min', 'max'):
+            if not math.isnan(value):
+                # the values before a lower (higher) one can't be the min (max) any more
+                while self.extremes and (self.extremes[-1][1] >= value if self.statistic == 'min' else self.extremes[-1][1] <= value):
+                    self.extremes.pop()
+                self.extremes.append((position, value))
+            while self.extremes and self.extremes[0][0] <= position - self.window:
+                self.extremes.popleft()
+            return self.extremes[0][1] if self.extremes else np.nan
+
+        if len(self.values) == self.window:
+            self.exclude(self.values.get(self.window - 1))
+        self.values.append(value)
+        if self.added % self.window == 0:
+            self.recompute()
+        else:
+            self.include(value)
+
+        if self.statistic == 'mean':
+            return self.mean if self.n else np.nan
+        # sample std like pandas, the rounding errors of a constant window can make the sum slightly negative
+        return math.sqrt(max(self.m2, 0.0) / (self.n - 1)) if self.n > 1 else np.nan
+
+class LiveSeries:
+    def __init__(self, country, capacity, families=FAMILIES):
+        # The registered metrics with a compute function need whole blocks of rows, they are left out
+        metrics = [(col, key) for col, _, key, _ in get_metric_columns([country], families) if not isinstance(key, str)]
+        self.country = country
+        self.columns = [country] + [col for col, _ in metrics]
+        self.keys = list(dict.fromkeys(key for _, key in metrics))
+        self.key_columns = [self.keys.index(key) for _, key in metrics] # Key of every derived column
+        self.periods = sorted({int(source.split('_')[1]) for source, _, _, _ in self.keys if source.startswith('pct_')})
+
+        self.times = RingBuffer(capacity, dtype='int64') # Datetime of every row in nanoseconds
+        self.rows = RingBuffer(capacity, len(self.columns)) # Price and derived columns of the last capacity rows
+        self.filled = RingBuffer(max(self.periods, default=0) + 1) # Forward filled prices for the percentage changes
+        self.windows = {key: RollingWindow(key[1], key[2]) for key in self.keys if key[1] is not None}
+
+    def __repr__(self):
+        return f"LiveSeries({self.country}, {len(self.rows)} of {self.rows.capacity} rows)"
+
+    @property
+    def nbytes(self):
+        buffers = [self.times, self.rows, self.filled] + [window.values for window in self.windows.values()]
+        return sum(buffer.data.nbytes for buffer in buffers)
+
+    @property
+    def last_time(self):
+        return pd.Timestamp(int(self.times.get())) if self.times.count else None
+
+    def get_sources(self, price):
+        # The price and its percentage changes like pct_change_block, after padding the missing prices
+        last = self.filled.get() if self.filled.count else np.nan
+        self.filled.append(last if math.isnan(price) else price)
+        sources = {'price': price}
+        for periods in self.periods:
+            current = self.filled.get()
+            previous = self.filled.get(periods) if self.filled.count > periods else np.nan
+            with np.errstate(divide='ignore', invalid='ignore'):
+                sources[f'pct_{periods}'] = float(np.float64(current) / previous - 1)
+        return sources
+
+    def add(self, time, price):
+        # Adds the price of the next row, the rows that are not newer than the last one are skipped
+        time = pd.Timestamp(time)
+        if time.tzinfo is not None:
+            time = time.tz_convert('UTC').tz_localize(None)
+        if self.times.count and time.value <= self.times.get():
+            return False
+        price = float(price)
+        sources = self.get_sources(price)
+
+        results = []
+        for source, window, statistic, scale in self.keys:
+            key = (source, window, statistic, scale)
+            value = sources[source] if window is None else self.windows[key].add(sources[source])
+            results.append(value * scale if scale != 1 else value)
+
+        self.times.append(time.value)
+        self.rows.append([price] + [results[i] for i in self.key_columns])
+        return True
+
+    def extend(self, index, prices=None):
+        # Adds the prices of a series or of an index and its values, returns the number of new rows
+        if isinstance(index, pd.Series):
+            index, prices = index.index, index.to_numpy()
+        return sum(self.add(time, price) for time, price in zip(index, prices))
+
+    def frame(self):
+        # The rows in the buffer, indexed by Datetime like the processed output
+        index = pd.DatetimeIndex(self.times.values().copy(), name='Datetime')
+        return pd.DataFrame(self.rows.values().copy(), index=index, columns=self.columns)
@@ -0,0 +1,116 @@
+import os
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+from process_data import METRIC_REGISTRY, BLOCK_ROWS, compute_stat, get_lookback, get_metric_key
+
+# On-demand derived columns for the output saved with LAZY_METRICS
+
+class LazyMetrics:
+    def __init__(self, prices, max_bytes=256 * 2**20, persist_folder=None, dataset_hash=None):
+        # prices: the price columns of the whole output (from its first row), indexed by Datetime
+        self.index = pd.DatetimeIndex(prices.index)
+        self.countries = list(prices.columns)
+        self.prices = prices.to_numpy(dtype='float64')
+        self.max_bytes = max_bytes # Least recently used blocks are dropped above this size (None = no limit)
+        self.lookback = get_lookback()
+        self.block_rows = BLOCK_ROWS
+        self.blocks = OrderedDict() # (key, block number): values of the block for every country
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        # the computed blocks are also saved as .npy files, in a folder per dataset hash
+        self.persist_folder = None
+        if persist_folder is not None:
+            self.persist_folder = os.path.join(persist_folder, dataset_hash or 'default')
+            os.makedirs(self.persist_folder, exist_ok=True)
+
+    def __repr__(self):
+        return f"LazyMetrics({len(self.index)} rows, {len(self.countries)} countries, {self.nbytes} bytes cached)"
+
+    def get_column(self, col):
+        # (key, country index) of a derived column, (None, country index) of a price column
+        if col in self.countries:
+            return None, self.countries.index(col)
+        for i, country in enumerate(self.countries):
+            suffix = col[len(country) + 1:]
+            if col.startswith(f"{country}_") and suffix in METRIC_REGISTRY:
+                return get_metric_key(suffix), i
+        raise KeyError(f"Unknown column: {col}")
+
+    def get_block_filename(self, key, block):
+        name = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+        return os.path.join(self.persist_folder, f"{name}_{block}.npy")
+
+    def compute_block(self, key, block):
+        # Same rows as process_all_data uses, so the values are the same as the saved ones would be
+        block_start = block * self.block_rows
+        first = max(block_start - self.lookback, 0)
+        block_end = min(block_start + self.block_rows, len(self.index))
+        values = compute_stat({'price': self.prices[first:block_end]}, key)
+        return np.ascontiguousarray(values[block_start - first:])
+
+    def get_block(self, key, block):
+        cache_key = (key, block)
+        if cache_key in self.blocks:
+            self.blocks.move_to_end(cache_key)
+            self.hits += 1
+            return self.blocks[cache_key]
+
+        self.misses += 1
+        values = None
+        # the last block is not complete, it changes when rows are added
+        complete = (block + 1) * self.block_rows <= len(self.index)
+        filename = self.get_block_filename(key, block) if self.persist_folder and complete else None
+        if filename and os.path.exists(filename):
+            try:
+                values = np.load(filename)
+            except (OSError, ValueError):
+                values = None
+        if values is None:
+            values = self.compute_block(key, block)
+            if filename:
+                np.save(filename, values)
+
+        self.blocks[cache_key] = values
+        self.nbytes += values.nbytes
+        self.evict()
+        return values
+
+    def evict(self):
+        # keep the block just added even if it is bigger than max_bytes
+        while self.max_bytes is not None and self.nbytes > self.max_bytes and len(self.blocks) > 1:
+            _, values = self.blocks.popitem(last=False)
+            self.nbytes -= values.nbytes
+
+    def get_values(self, key, start_row, end_row):
+        # values of the rows start_row..end_row for every country
+        first_block = start_row // self.block_rows
+        last_block = (end_row - 1) // self.block_rows
+        parts = [self.get_block(key, block) for block in range(first_block, last_block + 1)]
+        values = parts[0] if len(parts) == 1 else np.concatenate(parts)
+        offset = first_block * self.block_rows
+        return values[start_row - offset:end_row - offset]
+
+    def get_frame(self, columns, start=None, end=None):
+        # Rows between start and end of the given price and derived columns, indexed by Datetime
+        rows = self.index.slice_indexer(start, end)
+        start_row, end_row = rows.start or 0, rows.stop if rows.stop is not None else len(self.index)
+        data = {}
+        for col in columns:
+            key, i = self.get_column(col)
+            if end_row <= start_row:
+                data[col] = np.empty(0)
+            elif key is None:
+                data[col] = self.prices[start_row:end_row, i]
+            else:
+                data[col] = self.get_values(key, start_row, end_row)[:, i]
+        return pd.DataFrame(data, index=self.index[start_row:end_row], columns=list(columns))
+
+    def corr(self, columns, start=None, end=None):
+        return self.get_frame(columns, start, end).corr()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'blocks': len(self.blocks), 'bytes': self.nbytes}
@@ -1,17 +1,90 @@
 import os
+import sys
+import json
+import math
+import shutil
+import uuid
+import warnings
+import hashlib
+import time
+import numpy as np
 import pandas as pd
-from sqlalchemy import create_engine, inspect
+from multiprocessing import shared_memory
+from sqlalchemy import create_engine, inspect, text
+
+from scheduler import Task, run_tasks, print_timings
+from corr_index import CorrIndex, load_corr_index
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+from instrumentation import traced
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
 
 # Global variables
 
 COLUMNS = {}
 
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sqlite') # 'sqlite' or 'parquet' (needs pyarrow)
+IN_FILENAME = 'data/FR-NL-BE-HU-RO_2020-01-01_2020-03-01.sqlite' # Collected dataset in the data_collection folder
+OUT_FILENAME = 'data/final.sqlite' # Processed dataset in the data_processing folder
+INPUT_COUNTRIES = None # Only load these countries from the parquet input (None = all)
+INPUT_START = None # Only load the parquet input from this date (None = from the first date)
+INPUT_END = None # Only load the parquet input until this date (None = until the last date)
+
+# Derived columns: (family, suffix, source, window, statistic, scale, description)
+# source 'price' is the country's price, 'pct_<n>' is its percentage change over n hours (as a ratio)
+# the same (source, window, statistic) is only computed once, no matter how many columns use it
+METRICS = [
+    ('moving_average', '7d_MA', 'price', 7*24, 'mean', 1, '7 day moving average of {col}'),
+    ('moving_average', '30d_MA', 'price', 30*24, 'mean', 1, '30 day moving average of {col}'),
+    ('weekly_means', 'weekly_mean', 'price', 7*24, 'mean', 1, 'Weekly mean of {col}'),
+    ('weekly_min_max_values', 'weekly_min', 'price', 7*24, 'min', 1, 'Weekly min of {col}'),
+    ('weekly_min_max_values', 'weekly_max', 'price', 7*24, 'max', 1, 'Weekly max of {col}'),
+    ('pct_changes', 'daily_pct_change', 'pct_24', None, 'value', 100, 'Daily percentage change of {col}'),
+    ('pct_changes', 'weekly_pct_change', 'pct_168', None, 'value', 100, 'Weekly percentage change of {col}'),
+    ('pct_changes', 'monthly_pct_change', 'pct_720', None, 'value', 100, 'Monthly percentage change of {col}'),
+    ('volatility', 'daily_volatility', 'pct_24', 24, 'std', 100, 'Daily volatility of {col}'),
+    ('volatility', 'weekly_volatility', 'pct_168', 7*24, 'std', 100, 'Weekly volatility of {col}'),
+    ('volatility', 'monthly_volatility', 'pct_720', 30*24, 'std', 100, 'Monthly volatility of {col}'),
+    ('peaks', 'peak_hours', 'price', 24, 'max', 1, 'Peak hours of {col}'),
+    ('peaks', 'peak_weeks', 'price', 7*24, 'max', 1, 'Peak weeks of {col}'),
+]
+FAMILIES = ['moving_average', 'weekly_means', 'weekly_min_max_values', 'pct_changes', 'volatility', 'peaks']
+METRIC_REGISTRY = {} # suffix: family, description, key or compute function and lookback of every derived column type
+
+LAZY_METRICS = False # Only save the prices and the date columns, the derived columns are computed on demand (see metric_store.py)
+
+INCREMENTAL = True # Only process the new rows of the input when the output already exists
+BLOCK_ROWS = 90*24 # The rolling statistics are computed in blocks of this many rows (see process_all_data)
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f' # Same text format as pandas to_sql uses in SQLite
+
+PARALLEL_WORKERS = 1 # Number of workers computing the rolling statistics (1 = no workers)
+PARALLEL_EXECUTOR = 'process' # 'process' or 'thread' workers
+
+CORR_SEGMENT_ROWS = 30*24 # Rows between two checkpoints of the correlation index, or a multiple of it with many columns (see get_corr_segment_rows)
+
+# Levels of the aggregation pyramid: (table, resample frequency), the daily level is aggregated from the hourly rows,
+# the others from the daily level. Every level keeps PYRAMID_AGGS of every price and derived column, as {col}__{agg}
+PYRAMID_LEVELS = [('df_daily', 'D'), ('df_weekly', 'W-MON'), ('df_monthly', 'MS')]
+PYRAMID_AGGS = ['min', 'max', 'mean', 'first', 'last', 'count']
+
+COMPACT_DTYPES = False # float32 derived columns, int8 Month/Day/Hour and a categorical AM/PM (the prices stay float64)
+AM_PM_DTYPE = pd.CategoricalDtype(['AM', 'PM'])
+
+STREAMING = False # Read, process and save the input in chunks, so the memory use doesn't grow with the dataset
+CHUNK_BLOCKS = 4 # Number of BLOCK_ROWS blocks in one chunk of the streaming processing
+
 # helper functions
 
 def get_path(foldername, filename):
-    running_dir = os.getcwd()
-    parent_dir = os.path.dirname(running_dir)
-    full_filename = os.path.join(parent_dir, foldername, filename)
+    # Relative to the project folder, so the script can run from any working directory
+    full_filename = os.path.join(ROOT_DIR, foldername, filename)
     full_filename = full_filename.replace('\\', '/')
     full_filename = full_filename[0].upper() + full_filename[1:]
 
@@ -19,13 +92,11 @@ def get_path(foldername, filename):
     return full_filename
 
 def get_in_filename():
-    filename = 'data/FR-NL-BE-HU-RO_2020-01-01_2020-03-01.sqlite'
-    full_filename = get_path('data_collection', filename)
+    full_filename = get_path('data_collection', IN_FILENAME)
     return full_filename
 
 def get_out_filename():
-    filename = 'data/final.sqlite'
-    full_filename = get_path('data_processing', filename)
+    full_filename = get_path('data_processing', OUT_FILENAME)
     return full_filename
 
 def create_folder(filename):
@@ -50,13 +121,20 @@ def get_engine(filename):
 def get_table_names(engine):
     try:
         inspector = inspect(engine)
-        table_names = inspector.get_table_names()
+        table_names = inspector.get_table_names() + inspector.get_view_names()
         print(f"Table names: {table_names}")
     except Exception as e:
         print(f"Error: {e}")
         raise ValueError('Error getting table names')
     return table_names
 
+def get_input_table(table_names):
+    # The incremental collection stores the prices next to its bookkeeping tables
+    if 'prices' in table_names:
+        return 'prices'
+    return table_names[0]
+
+@traced()
 def get_data(engine, table_name):
     try:
         df = pd.read_sql_table(table_name, engine)
@@ -65,6 +143,7 @@ def get_data(engine, table_name):
         raise ValueError('Error getting df')
     return df
 
+@traced()
 def preprocess_data(df):
     try:
         df['Datetime'] = pd.to_datetime(df['Datetime'])
@@ -86,103 +165,369 @@ def add_column_to_dict(col_name, description, columns=COLUMNS):
     columns[col_name] = description
     return columns
 
-def save_to_sqlite(dfs, filename):
+def get_key_lookback(key):
+    # Number of earlier rows a (source, window, statistic, scale) value depends on,
+    # e.g. the monthly volatility is a 720 hour window over 720 hour percentage changes
+    source, window, _, _ = key
+    periods = int(source.split('_')[1]) if source.startswith('pct_') else 0
+    return periods + (window or 1) - 1
+
+def register_metric(suffix, family, description, key=None, compute=None, lookback=0):
+    # Add a derived column type ({col}_{suffix} for every country). It is either a (source, window, statistic, scale)
+    # key, or a compute function that gets the prices (rows x countries array) and returns an array of the same shape
+    # using at most lookback earlier rows. compute has to be a top level function for the parallel processing.
+    if (key is None) == (compute is None):
+        raise ValueError('Give either a key or a compute function')
+    METRIC_REGISTRY[suffix] = {
+        'family': family,
+        'description': description,
+        'key': key,
+        'compute': compute,
+        'lookback': get_key_lookback(key) if key is not None else lookback,
+    }
+    if family not in FAMILIES:
+        FAMILIES.append(family)
+
+for family, suffix, source, window, statistic, scale, description in METRICS:
+    register_metric(suffix, family, description, key=(source, window, statistic, scale))
+
+def get_sqlite_type(dtype):
+    if pd.api.types.is_float_dtype(dtype):
+        return 'REAL'
+    if pd.api.types.is_integer_dtype(dtype):
+        return 'INTEGER'
+    return 'TEXT'
+
+def save_time_table(conn, key, df, append):
+    # Time indexed frames: the epoch seconds are the primary key, every column has its own type
+    if key not in append:
+        conn.execute(text(f'DROP TABLE IF EXISTS "{key}"'))
+        columns = ', '.join(f'"{col}" {get_sqlite_type(dtype)}' for col, dtype in df.dtypes.items())
+        conn.execute(text(f'CREATE TABLE "{key}" ("ts" INTEGER PRIMARY KEY, {columns})'))
+
+    # the NaNs are saved as NULLs
+    placeholders = ', '.join('?' * (len(df.columns) + 1))
+    ts = (pd.DatetimeIndex(df.index).asi8 // 10**9).tolist()
+    rows = list(zip(ts, *[df[col].tolist() for col in df.columns]))
+    conn.exec_driver_sql(f'INSERT INTO "{key}" VALUES ({placeholders})', rows)
+
+@traced()
+def save_to_sqlite(dfs, filename, append=()):
+    # the frames named in append are added to the existing tables
     try:
         engine = get_engine(filename)
+        with engine.connect() as conn:
+            conn.exec_driver_sql('PRAGMA journal_mode=WAL')
+        # every table is written in one transaction
+        with engine.begin() as conn:
+            for key, df in dfs.items():
+                if isinstance(df.index, pd.DatetimeIndex):
+                    save_time_table(conn, key, df, append)
         for key, df in dfs.items():
-            df.to_sql(key, engine, if_exists='replace')
+            if not isinstance(df.index, pd.DatetimeIndex):
+                df.to_sql(key, engine, if_exists='append' if key in append else 'replace')
+        # move the changes from the write-ahead log into the file, so the file alone has all of the data
+        with engine.connect() as conn:
+            conn.exec_driver_sql('PRAGMA wal_checkpoint(TRUNCATE)')
     except Exception as e:
         print(f"Error: {e}")
         raise ValueError('Error saving to sqlite')
     return None
 
-# process df
+def get_sqlite_columns(engine, table_name):
+    return [col['name'] for col in inspect(engine).get_columns(table_name)]
 
-def date_process(df):
+@traced()
+def read_sqlite(filename, table_name, columns=None, start=None, end=None):
+    # Rows between start and end of the given columns of a time table, the range and the columns are
+    # selected by SQLite (using the ts primary key), indexed by Datetime
+    if columns is None:
+        query = f'SELECT * FROM "{table_name}"'
+    else:
+        selected = ', '.join(['"ts"'] + [f'"{col}"' for col in columns])
+        query = f'SELECT {selected} FROM "{table_name}"'
+    conditions = []
+    params = {}
+    if start is not None:
+        conditions.append('"ts" >= :start')
+        params['start'] = pd.Timestamp(start).value // 10**9
+    if end is not None:
+        conditions.append('"ts" <= :end')
+        params['end'] = pd.Timestamp(end).value // 10**9
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
     try:
-        df['Month'] = df.index.month
-        df['Day'] = df.index.day
-        df['Hour'] = df.index.hour
-        df['AM/PM'] = df.index.strftime('%p')
+        df = pd.read_sql(text(query + ' ORDER BY "ts"'), get_engine(filename), params=params)
     except Exception as e:
         print(f"Error: {e}")
-        raise ValueError('Error df processing')
-    return df
+        raise ValueError('Error reading sqlite')
+    return frame_from_sqlite(df)
 
-def moving_average(df, column_names):
+def frame_from_sqlite(df):
+    # a REAL column without any value in the rows comes back as None objects
+    for col in df.columns[(df.dtypes == object) & df.isna().all().to_numpy()]:
+        df[col] = df[col].astype('float64')
+    df.index = pd.DatetimeIndex(pd.to_datetime(df['ts'], unit='s'), name='Datetime')
+    return df.drop(columns=['ts'])
+
+# Parquet storage
+
+def get_parquet_folder(filename):
+    return filename.replace('.sqlite', '.parquet')
+
+def check_pyarrow():
+    if pq is None:
+        raise ValueError('The parquet storage backend needs pyarrow, install it with: pip install pyarrow')
+
+def get_parquet_filters(start=None, end=None, countries=None):
+    # Filters on the partition keys skip the files outside of the range, the Datetime filters cut the rest
+    filters = []
+    if countries is not None:
+        filters.append(('country', 'in', list(countries)))
+    if start is not None:
+        start = pd.Timestamp(start)
+        filters.append(('month', '>=', start.strftime('%Y-%m')))
+        filters.append(('Datetime', '>=', start))
+    if end is not None:
+        end = pd.Timestamp(end)
+        filters.append(('month', '<=', end.strftime('%Y-%m')))
+        filters.append(('Datetime', '<=', end))
+    return filters or None
+
+@traced()
+def read_parquet(folder, columns=None, start=None, end=None, countries=None):
+    check_pyarrow()
     try:
-        for col in column_names:
-            df[f'{col}_7d_MA'] = df[col].rolling(window=7*24, min_periods=1).mean()  # 7 napos mozgóátlag
-            df[f'{col}_30d_MA'] = df[col].rolling(window=30*24, min_periods=1).mean()  # 30 napos mozgóátlag
-            add_column_to_dict(f'{col}_7d_MA', f'7 day moving average of {col}')
-            add_column_to_dict(f'{col}_30d_MA', f'30 day moving average of {col}')
+        # memory mapped read, only the requested columns and partitions are touched
+        table = pq.read_table(folder, columns=columns, filters=get_parquet_filters(start, end, countries), memory_map=True)
+        df = table.to_pandas(split_blocks=True, self_destruct=True)
     except Exception as e:
         print(f"Error: {e}")
-        raise ValueError('Error calculating moving average')
+        raise ValueError('Error reading parquet')
     return df
 
-def weekly_means(df, column_names):
+def read_parquet_prices(folder, countries=None, start=None, end=None):
+    # Read the long (country, Datetime, price) collection dataset into the wide format of get_data
+    df = read_parquet(folder, columns=['Datetime', 'price', 'country'], start=start, end=end, countries=countries)
+    df['country'] = df['country'].astype(str)
+    df = df.pivot(index='Datetime', columns='country', values='price')
+    df.columns.name = None
+    return df.reset_index()
+
+@traced()
+def save_to_parquet(dfs, folder, append=()):
+    # Time indexed frames are partitioned by month, the others are written to one file
+    # the frames named in append are added as new files to the existing partitions
+    check_pyarrow()
     try:
-        for col in column_names:
-            df[f'{col}_weekly_mean'] = df[col].rolling(window=7*24, min_periods=1).mean()
-            add_column_to_dict(f'{col}_weekly_mean', f'Weekly mean of {col}')
+        for key, df in dfs.items():
+            if isinstance(df.index, pd.DatetimeIndex):
+                df = df.reset_index()
+                df['month'] = df[df.columns[0]].dt.strftime('%Y-%m')
+                if key in append:
+                    pq.write_to_dataset(pa.Table.from_pandas(df, preserve_index=False), os.path.join(folder, key),
+                                        partition_cols=['month'], existing_data_behavior='overwrite_or_ignore',
+                                        basename_template=f'part-{uuid.uuid4().hex}-{{i}}.parquet')
+                else:
+                    pq.write_to_dataset(pa.Table.from_pandas(df, preserve_index=False), os.path.join(folder, key),
+                                        partition_cols=['month'], existing_data_behavior='delete_matching')
+            else:
+                os.makedirs(os.path.join(folder, key), exist_ok=True)
+                pq.write_table(pa.Table.from_pandas(df), os.path.join(folder, key, 'part-0.parquet'))
     except Exception as e:
         print(f"Error: {e}")
-        raise ValueError('Error calculating weekly means')
-    return df
+        raise ValueError('Error saving to parquet')
+    return None
 
-def weekly_min_max_values(df, column_names):
+# Catalog
+
+def get_catalog_filename(filename):
+    # Small JSON file next to the dataset, so the row counts, dates and columns can be read without loading the data
+    return f"{filename}.catalog.json"
+
+def hash_path(path):
+    # Content hash of a file or of every file in a folder
+    sha = hashlib.sha256()
+    if os.path.isdir(path):
+        paths = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names if not name.endswith('.tmp'))
+    else:
+        paths = [path]
+    for file_path in paths:
+        sha.update(os.path.relpath(file_path, path).encode())
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+def read_catalog(filename):
     try:
-        for col in column_names:
-            df[f'{col}_weekly_min'] = df[col].rolling(window=7*24, min_periods=1).min()
-            df[f'{col}_weekly_max'] = df[col].rolling(window=7*24, min_periods=1).max()
-            add_column_to_dict(f'{col}_weekly_min', f'Weekly min of {col}')
-            add_column_to_dict(f'{col}_weekly_max', f'Weekly max of {col}')
-    except Exception as e:
-        print(f"Error: {e}")
-        raise ValueError('Error calculating min max values')
-    return df
+        with open(get_catalog_filename(filename)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
 
-def pct_changes(df, column_names):
+def summarize(df, country_codes, summary=None):
+    # Row counts, dates and columns of the processed df, added to the summary of the earlier chunks
+    # the number and the sum of the prices of every country show the next incremental run if the input changed
+    counts = df[list(country_codes)].count()
+    sums = df[list(country_codes)].sum()
+    if summary is None:
+        summary = {'rows': 0, 'first': df.index.min(), 'last': df.index.max(), 'columns': list(df.columns),
+                   'dtypes': get_dtypes(df), 'counts': {country: 0 for country in country_codes},
+                   'sums': {country: 0.0 for country in country_codes}}
+    summary['rows'] += int(df.index.size)
+    summary['first'] = min(summary['first'], df.index.min())
+    summary['last'] = max(summary['last'], df.index.max())
+    for country in country_codes:
+        summary['counts'][country] += int(counts[country])
+        summary['sums'][country] += float(sums[country])
+    return summary
+
+def get_catalog_summary(catalog, df):
+    # The summary of the already processed rows from their catalog, so they don't have to be read again
+    if catalog is None:
+        return None
+    return {'rows': catalog['rows'], 'first': pd.Timestamp(catalog['first']), 'last': pd.Timestamp(catalog['last']),
+            'columns': list(df.columns), 'dtypes': get_dtypes(df), 'counts': {country: info['rows'] for country, info in catalog['countries'].items()},
+            'sums': {country: info['sum'] for country, info in catalog['countries'].items()}}
+
+@traced()
+def write_catalog(filename, summary, in_filename, columns=COLUMNS):
+    # The input hash comes from the collection's catalog when it has one
+    # with LAZY_METRICS the derived columns are listed, but not saved
+    in_catalog = read_catalog(in_filename)
+    all_columns = list(summary['columns'])
+    if LAZY_METRICS:
+        all_columns += [col for col, _, _, _ in get_metric_columns(list(summary['counts']))]
+    catalog = {
+        'rows': summary['rows'],
+        'first': str(summary['first']),
+        'last': str(summary['last']),
+        'columns': all_columns,
+        'lazy': LAZY_METRICS,
+        'compact': COMPACT_DTYPES,
+        'dtypes': summary['dtypes'],
+        'countries': {country: {'rows': count, 'sum': summary['sums'][country]} for country, count in summary['counts'].items()},
+        'metrics': {col: description for col, description in columns.items() if col in all_columns},
+        'input_hash': in_catalog['hash'] if in_catalog else hash_path(in_filename),
+        'hash': hash_path(filename),
+        'updated': pd.Timestamp.now(tz='UTC').isoformat(),
+    }
+    with open(get_catalog_filename(filename), 'w') as f:
+        json.dump(catalog, f, indent=2)
+    return catalog
+
+# process df
+
+@traced()
+def date_process(df):
     try:
-        for col in column_names:
-            df[f'{col}_daily_pct_change'] = df[col].pct_change(periods=24) * 100  # Daily
-            df[f'{col}_weekly_pct_change'] = df[col].pct_change(periods=7*24) * 100  # Weekly
-            df[f'{col}_monthly_pct_change'] = df[col].pct_change(periods=30*24) * 100  # Monthly
-            add_column_to_dict(f'{col}_daily_pct_change', f'Daily percentage change of {col}')
-            add_column_to_dict(f'{col}_weekly_pct_change', f'Weekly percentage change of {col}')
-            add_column_to_dict(f'{col}_monthly_pct_change', f'Monthly percentage change of {col}')
+        df['Month'] = df.index.month
+        df['Day'] = df.index.day
+        df['Hour'] = df.index.hour
+        df['AM/PM'] = df.index.strftime('%p')
     except Exception as e:
         print(f"Error: {e}")
-        raise ValueError('Error calculating percentage changes')
+        raise ValueError('Error df processing')
     return df
 
-def volatility(df, column_names):
+def forward_fill(block):
+    # Fill the NaNs of every column with the last valid value above them (leading NaNs stay)
+    mask = np.isnan(block)
+    if not mask.any():
+        return block
+    idx = np.where(mask, 0, np.arange(block.shape[0])[:, None])
+    np.maximum.accumulate(idx, axis=0, out=idx)
+    return np.take_along_axis(block, idx, axis=0)
+
+def pct_change_block(block, periods):
+    # Same as DataFrame.pct_change(periods) (padding the NaNs first) on a 2-D array
+    filled = forward_fill(block)
+    shifted = np.full_like(filled, np.nan)
+    shifted[periods:] = filled[:-periods]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return filled / shifted - 1
+
+def compute_stat(sources, key):
+    # One (source, window, statistic, scale) for every column of sources['price'],
+    # or the registered metric when the key is its suffix
+    if isinstance(key, str):
+        return METRIC_REGISTRY[key]['compute'](sources['price'])
+    source, window, statistic, scale = key
+    if source not in sources:
+        sources[source] = pct_change_block(sources['price'], int(source.split('_')[1]))
+    if window is None:
+        values = sources[source]
+    else:
+        # one rolling pass over all countries
+        rolling = pd.DataFrame(sources[source]).rolling(window=window, min_periods=1)
+        values = getattr(rolling, statistic)().to_numpy()
+    return values * scale if scale != 1 else values
+
+def get_metric_key(suffix):
+    # The key compute_stat computes the metric by, metrics with the same key are only computed once
+    metric = METRIC_REGISTRY[suffix]
+    return metric['key'] if metric['key'] is not None else suffix
+
+def get_stat_keys(families=FAMILIES):
+    # The distinct keys of the families
+    keys = []
+    for suffix, metric in METRIC_REGISTRY.items():
+        if metric['family'] in families and get_metric_key(suffix) not in keys:
+            keys.append(get_metric_key(suffix))
+    return keys
+
+def get_metric_columns(column_names, families=FAMILIES):
+    # (column name, description, key, country index) in the order of adding the families one after the other
+    columns = []
+    for family in families:
+        for i, col in enumerate(column_names):
+            for suffix, metric in METRIC_REGISTRY.items():
+                if metric['family'] == family:
+                    columns.append((f'{col}_{suffix}', metric['description'].format(col=col), get_metric_key(suffix), i))
+    return columns
+
+@traced()
+def rolling_stats(df, column_names, families=FAMILIES):
+    # Compute the derived columns of the given families for every country at once
     try:
-        for col in column_names:
-            df[f'{col}_daily_volatility'] = df[col].pct_change(periods=24).rolling(window=24, min_periods=1).std() * 100  # Daily
-            df[f'{col}_weekly_volatility'] = df[col].pct_change(periods=7*24).rolling(window=7*24, min_periods=1).std() * 100  # Weekly
-            df[f'{col}_monthly_volatility'] = df[col].pct_change(periods=30*24).rolling(window=30*24, min_periods=1).std() * 100  # Monthly
-            add_column_to_dict(f'{col}_daily_volatility', f'Daily volatility of {col}')
-            add_column_to_dict(f'{col}_weekly_volatility', f'Weekly volatility of {col}')
-            add_column_to_dict(f'{col}_monthly_volatility', f'Monthly volatility of {col}')
+        column_names = list(column_names)
+        block = df[column_names].to_numpy(dtype='float64')   # rows x countries
+
+        sources = {'price': block}
+        results = {key: compute_stat(sources, key) for key in get_stat_keys(families)}
+
+        new_columns = {}
+        for col, description, key, i in get_metric_columns(column_names, families):
+            new_columns[col] = results[key][:, i]
+            add_column_to_dict(col, description)
+
+        df = df.drop(columns=[col for col in new_columns if col in df.columns])
+        df = pd.concat([df, pd.DataFrame(new_columns, index=df.index)], axis=1)
     except Exception as e:
         print(f"Error: {e}")
-        raise ValueError('Error calculating volatility')
+        raise ValueError('Error calculating rolling statistics')
     return df
 
+def moving_average(df, column_names):
+    return rolling_stats(df, column_names, families=['moving_average'])
+
+def weekly_means(df, column_names):
+    return rolling_stats(df, column_names, families=['weekly_means'])
+
+def weekly_min_max_values(df, column_names):
+    return rolling_stats(df, column_names, families=['weekly_min_max_values'])
+
+def pct_changes(df, column_names):
+    return rolling_stats(df, column_names, families=['pct_changes'])
+
+def volatility(df, column_names):
+    return rolling_stats(df, column_names, families=['volatility'])
+
 def peaks(df, column_names):
-    try:
-        for col in column_names:
-            df[f'{col}_peak_hours'] = df[col].rolling(window=24, min_periods=1).max()
-            df[f'{col}_peak_weeks'] = df[col].rolling(window=7*24, min_periods=1).max()
-            add_column_to_dict(f'{col}_peak_hours', f'Peak hours of {col}')
-            add_column_to_dict(f'{col}_peak_weeks', f'Peak weeks of {col}')
-    except Exception as e:
-        print(f"Error: {e}")
-        raise ValueError('Error calculating peak hours')
-    return df
+    return rolling_stats(df, column_names, families=['peaks'])
 
+@traced()
 def correlation_matrix(df):
     try:
         df2 = df.copy()
@@ -193,46 +538,623 @@ def correlation_matrix(df):
         raise ValueError('Error calculating correlation matrix')
     return corr
 
-def process_all_data(df, column_names):
-    df = date_process(df)
-    df = moving_average(df, column_names)
-    df = weekly_means(df, column_names)
-    df = weekly_min_max_values(df, column_names)
-    df = pct_changes(df, column_names)
-    df = volatility(df, column_names)
-    df = peaks(df, column_names)
+def get_corr_index_filename(filename):
+    return f"{filename}.corr_index.npz"
+
+def get_corr_segment_rows(column_count):
+    # A checkpoint has 4 numbers per pair of columns and a row one per column, segments of at least 4 rows
+    # per column keep the index smaller than the rows it covers
+    return CORR_SEGMENT_ROWS * -(-4 * column_count // CORR_SEGMENT_ROWS)
+
+@traced()
+def update_corr_index(index, df):
+    # Add the rows of df to the correlation index, a new index is started from the first chunk
+    # AM/PM as 0 and 1, the columns are converted one at a time instead of copying the frame
+    x = np.empty((len(df), len(df.columns)))
+    for i, col in enumerate(df.columns):
+        x[:, i] = (df[col] == 'PM').to_numpy() if col == 'AM/PM' else df[col].to_numpy(dtype='float64')
+    if index is None:
+        # shifting by the first chunk's means keeps the sums small and precise
+        # (a column without values in the first chunk is not shifted)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            shift = np.nan_to_num(np.nanmean(np.where(np.isfinite(x), x, np.nan), axis=0))
+        index = CorrIndex(df.columns, shift, get_corr_segment_rows(len(df.columns)))
+    return index.update(df.index, x)
+
+# Aggregation pyramid
+
+def get_value_columns(df):
+    date_columns = ['Month', 'Day', 'Hour', 'AM/PM']
+    return [col for col in df.columns if col not in date_columns]
+
+def get_agg(level, agg, columns):
+    # one aggregate of the columns, named by the columns
+    frame = level[[f"{col}__{agg}" for col in columns]]
+    frame.columns = columns
+    return frame
+
+def flatten_level(aggs, columns):
+    level = pd.concat([aggs[agg].add_suffix(f"__{agg}") for agg in PYRAMID_AGGS], axis=1)
+    level = level[[f"{col}__{agg}" for col in columns for agg in PYRAMID_AGGS]]
+    level.index.name = 'Datetime'
+    # periods without any rows (gaps in the data) are dropped
+    return level[aggs['count'].sum(axis=1) > 0]
+
+@traced()
+def aggregate_days(df, daily=None):
+    # Daily aggregates of the hourly rows of df, they replace the days of daily from the first day of df
+    columns = get_value_columns(df)
+    resampled = df[columns].resample('D', label='left', closed='left')
+    aggs = {agg: getattr(resampled, agg)() for agg in PYRAMID_AGGS}
+    aggs['count'] = aggs['count'].astype('float64')
+    days = flatten_level(aggs, columns)
+    if daily is None:
+        return days
+    return pd.concat([daily[daily.index < df.index.min().floor('D')], days])
+
+def coarsen_level(daily, freq):
+    # A coarser level from the daily one, the means are weighted by the number of hours
+    columns = [col[:-len('__count')] for col in daily.columns if col.endswith('__count')]
+    count = get_agg(daily, 'count', columns)
+    resample = lambda frame: frame.resample(freq, label='left', closed='left')
+    aggs = {
+        'min': resample(get_agg(daily, 'min', columns)).min(),
+        'max': resample(get_agg(daily, 'max', columns)).max(),
+        'first': resample(get_agg(daily, 'first', columns)).first(),
+        'last': resample(get_agg(daily, 'last', columns)).last(),
+        'count': resample(count).sum(),
+    }
+    with np.errstate(divide='ignore', invalid='ignore'):
+        aggs['mean'] = resample((get_agg(daily, 'mean', columns) * count).fillna(0)).sum() / aggs['count'].replace(0, np.nan)
+    return flatten_level(aggs, columns)
+
+@traced()
+def build_pyramid(daily):
+    if COMPACT_DTYPES:
+        daily = compact_frame(daily, [], PYRAMID_LEVELS[0][0])
+    levels = {}
+    for table, freq in PYRAMID_LEVELS:
+        levels[table] = daily if freq == 'D' else coarsen_level(daily, freq)
+        if COMPACT_DTYPES and freq != 'D':
+            levels[table] = compact_frame(levels[table], [], table)
+    return levels
+
+def read_level(out_file_name, table):
+    # A saved level, None if the output does not have it
+    if STORAGE_BACKEND == 'parquet':
+        folder = os.path.join(out_file_name, table)
+        if not os.path.isdir(folder):
+            return None
+        return read_parquet(folder).drop(columns=['month']).set_index('Datetime').sort_index()
+
+    if table not in get_table_names(get_engine(out_file_name)):
+        return None
+    return read_sqlite(out_file_name, table)
+
+def read_processed_rows(out_file_name, start):
+    # The processed rows from start
+    if STORAGE_BACKEND == 'parquet':
+        df = read_parquet(os.path.join(out_file_name, 'df'), start=start).drop(columns=['month'])
+        return apply_dtypes(df.set_index('Datetime').sort_index(), get_saved_dtypes(out_file_name))
+
+    return apply_dtypes(read_sqlite(out_file_name, 'df', start=start), get_saved_dtypes(out_file_name))
+
+def get_lookback():
+    # Number of earlier rows the derived values depend on
+    return max((metric['lookback'] for metric in METRIC_REGISTRY.values()), default=0)
+
+def get_blocks(row_offset, start_row, end_row, block_rows, lookback):
+    # (first, keep_from, block_end) of every block: the rows first..block_end are needed
+    # to compute the rows keep_from..block_end
+    blocks = []
+    block_start = start_row - start_row % block_rows
+    while block_start < end_row:
+        first = max(block_start - lookback, 0)
+        if first < row_offset:
+            raise ValueError('The data does not contain the lookback rows of the block')
+        blocks.append((first, max(block_start, start_row), min(block_start + block_rows, end_row)))
+        block_start += block_rows
+    return blocks
+
+@traced()
+def order_columns(df, column_names):
+    # keep the column order of the full processing: prices, date columns, derived columns
+    date_columns = ['Month', 'Day', 'Hour', 'AM/PM']
+    return df[list(column_names) + date_columns + [col for col in df.columns if col not in date_columns and col not in column_names]]
+
+@traced()
+def process_all_data(df, column_names, row_offset=0, start_row=0, block_rows=None):
+    # The rolling statistics are computed per block of block_rows rows (counted from the first row of the dataset),
+    # each block starts from the lookback rows before it. So a value only depends on the rows of its own block
+    # and its lookback, and appending new rows later gives exactly the same values as processing everything again.
+    # row_offset: position of the first row of df in the whole dataset
+    # start_row: only the rows from this position are returned, df has to contain the lookback rows before it
+    block_rows = block_rows or BLOCK_ROWS
+    if LAZY_METRICS:
+        df = process_prices_only(df, column_names, row_offset, start_row)
+    elif PARALLEL_WORKERS > 1:
+        df = process_all_data_parallel(df, column_names, row_offset, start_row, block_rows)
+    else:
+        parts = []
+        for first, keep_from, block_end in get_blocks(row_offset, start_row, row_offset + len(df), block_rows, get_lookback()):
+            df_block = rolling_stats(df.iloc[first - row_offset:block_end - row_offset], column_names)
+            parts.append(df_block.iloc[keep_from - first:])
+
+        df = pd.concat(parts)
+        df = date_process(df)
+        df = order_columns(df, column_names)
+
+    if COMPACT_DTYPES:
+        df = compact_frame(df, column_names, 'Processed rows')
     return df
 
+@traced()
+def process_prices_only(df, column_names, row_offset=0, start_row=0):
+    # The derived columns are only described, metric_store.LazyMetrics computes them from the prices when they are read
+    for col, description, _, _ in get_metric_columns(column_names):
+        add_column_to_dict(col, description)
+    df = date_process(df.iloc[start_row - row_offset:][list(column_names)].copy())
+    return order_columns(df, column_names)
+
+# Compact dtypes
+
+def get_dtypes(df):
+    return {col: str(dtype) for col, dtype in df.dtypes.items()}
+
+@traced()
+def compact_frame(df, column_names, name):
+    # float32 for the float columns other than column_names, int8 calendar fields and a categorical AM/PM
+    before = df.memory_usage(deep=True).sum()
+    dtypes = {col: 'float32' for col, dtype in df.dtypes.items() if col not in column_names and pd.api.types.is_float_dtype(dtype)}
+    dtypes.update({col: 'int8' for col in ['Month', 'Day', 'Hour'] if col in df.columns})
+    if 'AM/PM' in df.columns:
+        dtypes['AM/PM'] = AM_PM_DTYPE
+    df = df.astype(dtypes)
+    after = df.memory_usage(deep=True).sum()
+    print(f"{name}: {after / 2**20:.2f} MB instead of {before / 2**20:.2f} MB ({1 - after / max(before, 1):.0%} saved)")
+    return df
+
+def apply_dtypes(df, dtypes):
+    # Back to the saved dtypes after reading (SQLite only has 64 bit numbers and text)
+    if not dtypes:
+        return df
+    return df.astype({col: AM_PM_DTYPE if dtype == 'category' else dtype
+                      for col, dtype in dtypes.items() if col in df.columns and (dtype == 'category' or str(df[col].dtype) != dtype)})
+
+def get_saved_dtypes(out_file_name):
+    catalog = read_catalog(out_file_name)
+    return catalog.get('dtypes') if catalog else None
+
+# Parallel processing
+
+def attach_array(name, shape):
+    memory = shared_memory.SharedMemory(name=name)
+    return memory, np.ndarray(shape, dtype='float64', buffer=memory.buf)
+
+def get_block_offsets(blocks):
+    # Position of every block in an array of the blocks one after the other (with their lookback rows)
+    offsets = [0]
+    for first, _, block_end in blocks:
+        offsets.append(offsets[-1] + block_end - first)
+    return offsets
+
+def source_task(prices_name, prices_shape, sources_name, sources_shape, source_index, periods, columns, blocks, row_offset):
+    # The percentage changes of a group of countries for every block, written into the shared sources
+    # for the statistics over them
+    prices_memory, prices = attach_array(prices_name, prices_shape)
+    sources_memory, sources = attach_array(sources_name, sources_shape)
+    try:
+        offsets = get_block_offsets(blocks)
+        for i, (first, _, block_end) in enumerate(blocks):
+            sources[source_index, offsets[i]:offsets[i + 1], columns[0]:columns[1]] = pct_change_block(
+                prices[first - row_offset:block_end - row_offset, columns[0]:columns[1]], periods)
+    finally:
+        del prices, sources
+        prices_memory.close()
+        sources_memory.close()
+    return None
+
+def stat_task(prices_name, prices_shape, sources_name, sources_shape, out_name, out_shape, key_index, key, source_index,
+              columns, blocks, row_offset, start_row, source_done=None):
+    # One (source, window, statistic) for a group of countries over every block, written into the shared output
+    # source_index: the percentage change of the key in the shared sources (None = the prices), its source_task
+    # has to be finished first, the task gets its result (None) as source_done
+    prices_memory, prices = attach_array(prices_name, prices_shape)
+    sources_memory, shared_sources = attach_array(sources_name, sources_shape)
+    out_memory, out = attach_array(out_name, out_shape)
+    sources = values = None # Views of the shared memory, they are released before closing it
+    try:
+        offsets = get_block_offsets(blocks)
+        for i, (first, keep_from, block_end) in enumerate(blocks):
+            sources = {'price': prices[first - row_offset:block_end - row_offset, columns[0]:columns[1]]}
+            if source_index is not None:
+                sources[key[0]] = shared_sources[source_index, offsets[i]:offsets[i + 1], columns[0]:columns[1]]
+            values = compute_stat(sources, key)
+            out[key_index, keep_from - start_row:block_end - start_row, columns[0]:columns[1]] = values[keep_from - first:]
+    finally:
+        del prices, shared_sources, out, sources, values
+        prices_memory.close()
+        sources_memory.close()
+        out_memory.close()
+    return None
+
+def date_task(index):
+    return date_process(pd.DataFrame(index=index))
+
+def create_shared_array(array):
+    memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype='float64', buffer=memory.buf)
+    shared[:] = array
+    return memory
+
+@traced()
+def process_all_data_parallel(df, column_names, row_offset=0, start_row=0, block_rows=None):
+    # Same result as process_all_data: the (statistic, country group) tasks and the date features run
+    # in PARALLEL_WORKERS workers, the prices and the results are shared between the processes
+    block_rows = block_rows or BLOCK_ROWS
+    column_names = list(column_names)
+    end_row = row_offset + len(df)
+    blocks = get_blocks(row_offset, start_row, end_row, block_rows, get_lookback())
+    keys = get_stat_keys()
+
+    prices = df[column_names].to_numpy(dtype='float64')
+    out_shape = (len(keys), end_row - start_row, len(column_names))
+    # every percentage change is computed once per group into the shared sources, the blocks one after the other
+    sources = sorted({key[0] for key in keys if not isinstance(key, str) and key[0] != 'price'})
+    sources_shape = (len(sources), get_block_offsets(blocks)[-1], len(column_names))
+    prices_memory = create_shared_array(prices)
+    sources_memory = create_shared_array(np.zeros(sources_shape))
+    out_memory = create_shared_array(np.zeros(out_shape))
+    try:
+        group_size = -(-len(column_names) // PARALLEL_WORKERS)
+        groups = [(i, min(i + group_size, len(column_names))) for i in range(0, len(column_names), group_size)]
+
+        group_names = [f"[{column_names[group[0]]}-{column_names[group[1] - 1]}]" for group in groups]
+        tasks = [Task('date_features', date_task, (df.index[start_row - row_offset:],))]
+        for source_index, source in enumerate(sources):
+            for group, group_name in zip(groups, group_names):
+                tasks.append(Task(f"{source}{group_name}", source_task, (prices_memory.name, prices.shape, sources_memory.name, sources_shape,
+                                                                         source_index, int(source.split('_')[1]), group, blocks, row_offset)))
+        # the tasks of the keys over a percentage change wait for its source task
+        for key_index, key in enumerate(keys):
+            source_index = sources.index(key[0]) if not isinstance(key, str) and key[0] in sources else None
+            for group, group_name in zip(groups, group_names):
+                key_name = key if isinstance(key, str) else f"{key[0]}_{key[2]}_{key[1]}"
+                inputs = [f"{key[0]}{group_name}"] if source_index is not None else []
+                tasks.append(Task(f"{key_name}{group_name}", stat_task, (prices_memory.name, prices.shape, sources_memory.name, sources_shape,
+                                                                         out_memory.name, out_shape, key_index, key, source_index,
+                                                                         group, blocks, row_offset, start_row), inputs))
+
+        start_time = time.perf_counter()
+        results, timings = run_tasks(tasks, PARALLEL_EXECUTOR, PARALLEL_WORKERS)
+        print_timings(timings, time.perf_counter() - start_time)
+
+        # assemble the columns in the same order as process_all_data
+        out = np.ndarray(out_shape, dtype='float64', buffer=out_memory.buf)
+        new_columns = {}
+        for col, description, key, i in get_metric_columns(column_names):
+            new_columns[col] = out[keys.index(key), :, i].copy()
+            add_column_to_dict(col, description)
+        del out
+
+        df_out = df.iloc[start_row - row_offset:][column_names]
+        df_out = pd.concat([df_out, results['date_features'], pd.DataFrame(new_columns, index=df_out.index)], axis=1)
+    finally:
+        prices_memory.close()
+        prices_memory.unlink()
+        sources_memory.close()
+        sources_memory.unlink()
+        out_memory.close()
+        out_memory.unlink()
+    return order_columns(df_out, column_names)
+
+# Incremental processing
+
+def get_processed_rows(out_file_name):
+    # number of rows and the last Datetime in the output
+    if STORAGE_BACKEND == 'parquet':
+        datetimes = read_parquet(os.path.join(out_file_name, 'df'), columns=['Datetime'])['Datetime']
+        return len(datetimes), datetimes.max()
+
+    engine = get_engine(out_file_name)
+    if 'ts' not in get_sqlite_columns(engine, 'df'):
+        print("The output was saved without the ts primary key.")
+        return 0, None
+    with engine.connect() as conn:
+        count, last = conn.execute(text('SELECT COUNT(*), MAX("ts") FROM "df"')).fetchone()
+    return count, pd.Timestamp(last, unit='s') if last is not None else None
+
+def get_input_datetimes(filename):
+    # Only the Datetime column of the input
+    if STORAGE_BACKEND == 'parquet':
+        df = read_parquet(filename, columns=['Datetime'], start=INPUT_START, end=INPUT_END, countries=INPUT_COUNTRIES)
+        return pd.DatetimeIndex(df['Datetime'].unique()).sort_values()
+
+    engine = get_engine(filename)
+    table_name = get_input_table(get_table_names(engine))
+    df = pd.read_sql(text(f'SELECT "Datetime" FROM "{table_name}" ORDER BY "Datetime"'), engine)
+    return pd.DatetimeIndex(pd.to_datetime(df['Datetime']))
+
+@traced()
+def get_input_data(filename, start=None):
+    # The input rows from start
+    if STORAGE_BACKEND == 'parquet':
+        if start is not None and INPUT_START is not None:
+            start = max(start, pd.Timestamp(INPUT_START))
+        return read_parquet_prices(filename, INPUT_COUNTRIES, start if start is not None else INPUT_START, INPUT_END)
+
+    engine = get_engine(filename)
+    table_name = get_input_table(get_table_names(engine))
+    if start is None:
+        return get_data(engine, table_name)
+    return pd.read_sql(text(f'SELECT * FROM "{table_name}" WHERE "Datetime" >= :start ORDER BY "Datetime"'), engine,
+                       params={'start': start.strftime(DATETIME_FORMAT)})
+
+def get_input_stats(filename, countries, end):
+    # (number of prices, sum of the prices) of every country in the input rows until end,
+    # aggregated by SQLite or from the price column of the parquet input, the rows are not read into a frame
+    if STORAGE_BACKEND == 'parquet':
+        df = read_parquet(filename, columns=['country', 'price'], start=INPUT_START, end=end, countries=countries)
+        prices = df.groupby(df['country'].astype(str))['price']
+        counts, sums = prices.count(), prices.sum()
+        return {country: (int(counts.get(country, 0)), float(sums.get(country, 0.0))) for country in countries}
+
+    engine = get_engine(filename)
+    table_name = get_input_table(get_table_names(engine))
+    selected = ', '.join(f'COUNT("{country}"), TOTAL("{country}")' for country in countries)
+    with engine.connect() as conn:
+        row = conn.execute(text(f'SELECT {selected} FROM "{table_name}" WHERE "Datetime" <= :end'),
+                           {'end': end.strftime(DATETIME_FORMAT)}).fetchone()
+    return {country: (int(row[2 * i]), float(row[2 * i + 1])) for i, country in enumerate(countries)}
+
+def input_changed(filename, catalog, last_processed):
+    # True if the input has other countries than the output, or other prices until the last processed row,
+    # e.g. a country added over the same dates or a failed chunk that was collected by a later run
+    countries = list(catalog['countries'])
+    if get_input_countries(filename) != countries:
+        print("The countries of the input changed.")
+        return True
+    if any('sum' not in info for info in catalog['countries'].values()):
+        print("The catalog of the output doesn't have the sums of the prices.")
+        return True
+    for country, (count, total) in get_input_stats(filename, countries, last_processed).items():
+        saved = catalog['countries'][country]
+        if count != saved['rows'] or not math.isclose(total, saved['sum'], rel_tol=1e-9, abs_tol=1e-6):
+            print(f"The prices of {country} changed before the last processed row.")
+            return True
+    return False
+
+def save_output(dfs, out_file_name, append=()):
+    if STORAGE_BACKEND == 'parquet':
+        save_to_parquet(dfs, out_file_name, append)
+    else:
+        save_to_sqlite(dfs, out_file_name, append)
+
+@traced()
+def process_new_rows(filename, out_file_name):
+    # returns False if the output is not a prefix of the input, then everything has to be processed again
+    catalog = read_catalog(out_file_name)
+    if catalog is None:
+        print("The output doesn't have a catalog.")
+        return False
+    if catalog.get('lazy', False) != LAZY_METRICS:
+        print("The derived columns were saved with a different LAZY_METRICS.")
+        return False
+    if catalog.get('compact', False) != COMPACT_DTYPES:
+        print("The output was saved with a different COMPACT_DTYPES.")
+        return False
+
+    done_rows, last_processed = get_processed_rows(out_file_name)
+    datetimes = get_input_datetimes(filename)
+
+    if done_rows == 0 or done_rows > len(datetimes) or datetimes[done_rows - 1] != last_processed:
+        print("The input changed before the last processed row.")
+        return False
+    if catalog['rows'] != done_rows or input_changed(filename, catalog, last_processed):
+        return False
+    if done_rows == len(datetimes):
+        print(f"Data already processed in {out_file_name}")
+        return True
+
+    # read the new rows together with the rows the first block needs
+    block_start = done_rows - done_rows % BLOCK_ROWS
+    row_offset = max(block_start - get_lookback(), 0)
+    df = preprocess_data(get_input_data(filename, datetimes[row_offset]))
+    country_codes = get_country_codes(df)
+
+    df_new = process_all_data(df, country_codes, row_offset=row_offset, start_row=done_rows)
+    print(f"Processing {len(df_new)} new rows after {last_processed}")
+
+    # the correlation index and the catalog only need the new rows, when the index is missing
+    # the whole output is read back one chunk at a time
+    index = load_corr_index(get_corr_index_filename(out_file_name))
+    if index is not None and (index.rows != done_rows or index.columns != list(df_new.columns)):
+        index = None
+    summary = get_catalog_summary(catalog, df_new)
+    daily = read_level(out_file_name, PYRAMID_LEVELS[0][0])
+
+    save_output({'df': df_new}, out_file_name, append=('df',))
+
+    # the last saved day is aggregated again together with the new rows
+    day_start = daily.index.max() if daily is not None and len(daily) else datetimes[0].floor('D')
+    daily = aggregate_days(read_processed_rows(out_file_name, day_start), daily)
+    save_output(build_pyramid(daily), out_file_name)
+
+    if index is None:
+        summary = None
+        for df in iter_processed_chunks(out_file_name, CHUNK_BLOCKS * BLOCK_ROWS):
+            index = update_corr_index(index, df)
+            summary = summarize(df, country_codes, summary)
+    else:
+        index = update_corr_index(index, df_new)
+        summary = summarize(df_new, country_codes, summary)
+    index.save(get_corr_index_filename(out_file_name))
+    save_output({'corr': index.corr()}, out_file_name)
+    write_catalog(out_file_name, summary, filename)
+    return True
+
+# Streaming processing
+
+def get_partition_months(folder):
+    # month=YYYY-MM partition values of a parquet dataset, without reading any data
+    months = set()
+    for _, dirs, _ in os.walk(folder):
+        months.update(d.split('=', 1)[1] for d in dirs if d.startswith('month='))
+    return sorted(months)
+
+def get_input_countries(filename):
+    if STORAGE_BACKEND == 'parquet':
+        countries = sorted(d.split('=', 1)[1] for d in os.listdir(filename) if d.startswith('country='))
+        if INPUT_COUNTRIES is not None:
+            countries = [country for country in countries if country in INPUT_COUNTRIES]
+        return countries
+
+    engine = get_engine(filename)
+    table_name = get_input_table(get_table_names(engine))
+    return [col['name'] for col in inspect(engine).get_columns(table_name) if col['name'] != 'Datetime']
+
+def iter_months(folder, start=None, end=None):
+    # (start, end) of the months in the dataset, cut to the start and end dates
+    for month in get_partition_months(folder):
+        month_start = pd.Timestamp(f'{month}-01')
+        month_end = month_start + pd.offsets.MonthBegin() - pd.Timedelta(microseconds=1)
+        if start is not None:
+            month_start = max(month_start, pd.Timestamp(start))
+        if end is not None:
+            month_end = min(month_end, pd.Timestamp(end))
+        if month_start <= month_end:
+            yield month_start, month_end
+
+def iter_input_chunks(filename, chunk_rows):
+    # The input in time order, a month (parquet) or chunk_rows rows (sqlite) at a time
+    if STORAGE_BACKEND == 'parquet':
+        for month_start, month_end in iter_months(filename, INPUT_START, INPUT_END):
+            df = read_parquet_prices(filename, INPUT_COUNTRIES, month_start, month_end)
+            if not df.empty:
+                yield df
+        return
+
+    engine = get_engine(filename)
+    table_name = get_input_table(get_table_names(engine))
+    yield from pd.read_sql(text(f'SELECT * FROM "{table_name}" ORDER BY "Datetime"'), engine, chunksize=chunk_rows)
+
+def iter_processed_chunks(out_file_name, chunk_rows):
+    # The processed df in time order, a month (parquet) or chunk_rows rows (sqlite) at a time
+    dtypes = get_saved_dtypes(out_file_name)
+    if STORAGE_BACKEND == 'parquet':
+        folder = os.path.join(out_file_name, 'df')
+        for month_start, month_end in iter_months(folder):
+            df = read_parquet(folder, start=month_start, end=month_end).drop(columns=['month'])
+            yield apply_dtypes(df.set_index('Datetime').sort_index(), dtypes)
+        return
+
+    engine = get_engine(out_file_name)
+    for df in pd.read_sql(text('SELECT * FROM "df" ORDER BY "ts"'), engine, chunksize=chunk_rows):
+        yield apply_dtypes(frame_from_sqlite(df), dtypes)
+
+def rechunk(chunks, chunk_rows):
+    # Regroup the frames into frames of exactly chunk_rows rows (the last one can be shorter)
+    buffer = []
+    buffered = 0
+    for df in chunks:
+        buffer.append(df)
+        buffered += len(df)
+        while buffered >= chunk_rows:
+            df = pd.concat(buffer, ignore_index=True)
+            yield df.iloc[:chunk_rows]
+            buffer = [df.iloc[chunk_rows:]]
+            buffered = len(buffer[0])
+    if buffered:
+        yield pd.concat(buffer, ignore_index=True)
+
+@traced()
+def process_streaming(filename, out_file_name):
+    # Every chunk is processed with the lookback rows of the previous one and saved before the next is read.
+    # The chunks are whole blocks, so the result is the same as processing everything at once.
+    country_codes = get_input_countries(filename)
+    chunk_rows = CHUNK_BLOCKS * BLOCK_ROWS
+    lookback = get_lookback()
+
+    carry = None
+    row = 0
+    index, summary, daily = None, None, None
+    day_rows = None
+    for df_chunk in rechunk(iter_input_chunks(filename, chunk_rows), chunk_rows):
+        df_chunk = preprocess_data(df_chunk).reindex(columns=country_codes)
+        df_in = df_chunk if carry is None else pd.concat([carry, df_chunk])
+
+        df_out = process_all_data(df_in, country_codes, row_offset=row - len(df_in) + len(df_chunk), start_row=row)
+        save_output({'df': df_out}, out_file_name, append=('df',) if row > 0 else ())
+        print(f"Processed rows {row} - {row + len(df_chunk)}")
+
+        # the new checkpoints are appended to the index file, only the current segment stays in memory
+        index = update_corr_index(index, df_out)
+        index.save(get_corr_index_filename(out_file_name))
+        summary = summarize(df_out, country_codes, summary)
+        # the last day can continue in the next chunk, its rows are aggregated again with it
+        df_days = df_out if day_rows is None else pd.concat([day_rows, df_out])
+        daily = aggregate_days(df_days, daily)
+        day_rows = df_out[df_out.index >= df_out.index.max().floor('D')]
+        carry = df_in.iloc[-lookback:]
+        row += len(df_chunk)
+
+    if index is None:
+        # an empty input, or INPUT_START and INPUT_END without any rows between them
+        print(f"No input rows in {filename}, nothing was processed.")
+        return None
+    save_output({'corr': index.corr(), **build_pyramid(daily)}, out_file_name)
+    write_catalog(out_file_name, summary, filename)
+
+
 # Main code
 
+@traced()
 def main():
     filename = get_in_filename()
     out_file_name = get_out_filename()
+    if STORAGE_BACKEND == 'parquet':
+        filename = get_parquet_folder(filename)
+        out_file_name = get_parquet_folder(out_file_name)
 
     # Check if data already processed
     if os.path.exists(out_file_name):
-        print(f"Data already processed in {filename}")
+        if not INCREMENTAL:
+            print(f"Data already processed in {filename}")
+            return None
+        if process_new_rows(filename, out_file_name):
+            print("Data processing completed.")
+            return None
+        print("Processing everything again.")
+        if os.path.isdir(out_file_name):
+            shutil.rmtree(out_file_name)
+
+    if STREAMING:
+        process_streaming(filename, out_file_name)
+        print("Data processing completed.")
         return None
-    
+
     # Process data
-    engine = get_engine(filename)
-    table_names = get_table_names(engine)
-    df = get_data(engine, table_names[0])
-    df = preprocess_data(df)
+    df = preprocess_data(get_input_data(filename))
     
     country_codes = get_country_codes(df)
     column_names = country_codes
 
     df = process_all_data(df, column_names)
 
-    corr = correlation_matrix(df)
+    index = update_corr_index(None, df)
+    index.save(get_corr_index_filename(out_file_name))
+    corr = index.corr()
 
     dfs = {
         'df': df,
-        'corr': corr
+        'corr': corr,
+        **build_pyramid(aggregate_days(df))
     }
 
-    save_to_sqlite(dfs, out_file_name)
+    save_output(dfs, out_file_name)
+
+    write_catalog(out_file_name, summarize(df, country_codes), filename)
 
     print(COLUMNS.keys())
     print("Data processing completed.")
@@ -0,0 +1,69 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+# Dependency-aware task runner for the processing
+
+class Task:
+    def __init__(self, name, func, args=(), inputs=()):
+        self.name = name # Unique name, other tasks refer to the result by it
+        self.func = func # Top level function, so it can be sent to a worker process
+        self.args = args
+        self.inputs = list(inputs) # Names of the tasks whose results are passed after args
+
+    def __repr__(self):
+        return f"Task({self.name})"
+
+def timed_call(func, args):
+    # Runs in the worker, so the times are measured where the work is done
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    result = func(*args)
+    return result, time.perf_counter() - wall_start, time.thread_time() - cpu_start, os.getpid()
+
+def get_executor(executor='process', max_workers=None):
+    if executor == 'process':
+        return ProcessPoolExecutor(max_workers=max_workers)
+    if executor == 'thread':
+        return ThreadPoolExecutor(max_workers=max_workers)
+    raise ValueError(f'Unknown executor: {executor}')
+
+def run_tasks(tasks, executor='process', max_workers=None):
+    # Runs every task as soon as all of its inputs are ready
+    # returns the results and the (name, wall time, cpu time, worker pid) of every task
+    names = {task.name for task in tasks}
+    for task in tasks:
+        missing = [name for name in task.inputs if name not in names]
+        if missing:
+            raise ValueError(f'Unknown inputs of {task.name}: {missing}')
+
+    results = {}
+    timings = []
+    pending = list(tasks)
+    running = {}
+
+    with get_executor(executor, max_workers) as pool:
+        while pending or running:
+            for task in [task for task in pending if all(name in results for name in task.inputs)]:
+                args = tuple(task.args) + tuple(results[name] for name in task.inputs)
+                running[pool.submit(timed_call, task.func, args)] = task
+                pending.remove(task)
+
+            if not running:
+                raise ValueError(f'Circular inputs between {[task.name for task in pending]}')
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                result, wall, cpu, pid = future.result()
+                results[task.name] = result
+                timings.append((task.name, wall, cpu, pid))
+
+    return results, timings
+
+def print_timings(timings, total=None):
+    for name, wall, cpu, pid in sorted(timings, key=lambda timing: -timing[1]):
+        print(f"{name:<40} wall {wall:8.3f} s  cpu {cpu:8.3f} s  pid {pid}")
+    if total is not None:
+        busy = sum(timing[2] for timing in timings)
+        print(f"Total {total:.3f} s, sum of task cpu times {busy:.3f} s, speedup {busy / total:.2f}x")
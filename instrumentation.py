@@ -0,0 +1,143 @@
+import os
+import sys
+import csv
+import json
+import time
+import atexit
+import cProfile
+import threading
+import functools
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+# Timing and memory records of the stages of the three scripts
+# TRACE_FILE: the records are appended to this file, as JSON lines or as CSV when it ends with .csv (not set = off)
+# TRACE_TRACEMALLOC=1: also record the peak of the Python allocations of every stage (slower)
+# TRACE_PROFILE: cProfile the whole run and dump the stats to this file at exit
+
+TRACE_FILE = os.environ.get('TRACE_FILE')
+TRACE_TRACEMALLOC = os.environ.get('TRACE_TRACEMALLOC') == '1'
+TRACE_PROFILE = os.environ.get('TRACE_PROFILE')
+
+FIELDS = ['script', 'stage', 'pid', 'thread', 'start', 'wall_s', 'cpu_s', 'max_rss_mb', 'peak_traced_mb', 'rows', 'bytes', 'error']
+
+LOCK = threading.Lock()
+LOCAL = threading.local() # Stack of the open stages of the thread, for the tracemalloc peaks of nested stages
+
+def get_max_rss_mb():
+    if resource is None:
+        return None
+    # kilobytes on Linux, bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2**20 if sys.platform == 'darwin' else max_rss / 2**10
+
+def get_size(obj):
+    # (rows, bytes) of a frame, a series or a dict or list of them, (None, None) for anything else
+    if hasattr(obj, 'memory_usage') and hasattr(obj, '__len__'):
+        memory = obj.memory_usage(index=True)
+        return len(obj), int(memory.sum() if hasattr(memory, 'sum') else memory)
+    if isinstance(obj, dict):
+        obj = list(obj.values())
+    if isinstance(obj, (list, tuple)):
+        sizes = [get_size(item) for item in obj]
+        sizes = [size for size in sizes if size[0] is not None]
+        if sizes:
+            return sum(rows for rows, _ in sizes), sum(size for _, size in sizes)
+    return None, None
+
+def write_record(record):
+    with LOCK:
+        if TRACE_FILE.endswith('.csv'):
+            new_file = not os.path.exists(TRACE_FILE) or os.path.getsize(TRACE_FILE) == 0
+            with open(TRACE_FILE, 'a', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=FIELDS)
+                if new_file:
+                    writer.writeheader()
+                writer.writerow(record)
+        else:
+            with open(TRACE_FILE, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+@contextmanager
+def stage(name, rows=None, size=None):
+    # with stage('name') as record: ... record['rows'] and record['bytes'] can be set inside
+    record = {'stage': name, 'rows': rows, 'bytes': size}
+    if not TRACE_FILE:
+        yield record
+        return
+
+    stack = getattr(LOCAL, 'stack', None)
+    if stack is None:
+        stack = LOCAL.stack = []
+    if TRACE_TRACEMALLOC:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if stack:
+            stack[-1]['peak'] = max(stack[-1]['peak'], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+    frame = {'peak': 0}
+    stack.append(frame)
+
+    record.update({'script': os.path.basename(sys.argv[0]), 'pid': os.getpid(), 'thread': threading.current_thread().name,
+                   'start': time.time(), 'error': None})
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = type(e).__name__
+        raise
+    finally:
+        record['wall_s'] = time.perf_counter() - wall_start
+        record['cpu_s'] = time.thread_time() - cpu_start
+        record['max_rss_mb'] = get_max_rss_mb()
+        stack.pop()
+        record['peak_traced_mb'] = None
+        if TRACE_TRACEMALLOC:
+            # the peak of a stage includes the peaks of the stages inside it
+            peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+            record['peak_traced_mb'] = peak / 2**20
+            if stack:
+                stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+        write_record({field: record.get(field) for field in FIELDS})
+
+def traced(name=None):
+    # Decorator: a stage for every call, the rows and bytes come from the returned frames or else from the arguments
+    def decorator(func):
+        stage_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not TRACE_FILE:
+                return func(*args, **kwargs)
+            with stage(stage_name) as record:
+                result = func(*args, **kwargs)
+                rows, size = get_size(result)
+                if rows is None:
+                    rows, size = get_size(list(args) + list(kwargs.values()))
+                record['rows'], record['bytes'] = rows, size
+            return result
+        return wrapper
+    return decorator
+
+def start_profile():
+    profile = cProfile.Profile()
+    profile.enable()
+    pid = os.getpid()
+
+    def dump():
+        # only the process that started the profile writes it, not the workers
+        if os.getpid() == pid:
+            profile.disable()
+            profile.dump_stats(TRACE_PROFILE)
+            print(f"Profile saved in {TRACE_PROFILE}")
+    atexit.register(dump)
+
+if TRACE_PROFILE and __name__ != '__main__':
+    start_profile()
@@ -0,0 +1,151 @@
+import os
+import sys
+import json
+import hashlib
+import pandas as pd
+
+# Run from any folder: python pipeline.py [collect|process|serve]
+# Runs the stages up to the given one (default: serve, the app). A stage is skipped when the cache has its output
+# for the same content hash of its inputs and parameters, and the output was not changed or deleted since
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+for folder in ('data_collection', 'data_processing', 'ui'):
+    sys.path.insert(0, os.path.join(ROOT_DIR, folder))
+
+import collect_data
+import process_data
+from instrumentation import stage
+
+# Global variables
+
+STAGES = ['collect', 'process', 'serve']
+CACHE_FILENAME = os.path.join(ROOT_DIR, 'pipeline_cache.json') # Outputs of the earlier runs by the hash of their inputs and parameters
+
+# Helper functions
+
+def get_key(name, params, inputs):
+    text = json.dumps({'stage': name, 'params': params, 'inputs': inputs}, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def read_cache():
+    try:
+        with open(CACHE_FILENAME) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_cache(cache):
+    # written to a temporary file first, an interrupted run doesn't leave half a cache behind
+    with open(f"{CACHE_FILENAME}.tmp", 'w') as f:
+        json.dump(cache, f, indent=2)
+    os.replace(f"{CACHE_FILENAME}.tmp", CACHE_FILENAME)
+
+def get_output_hash(path):
+    # The content hash from the catalog the stage wrote next to its output, older outputs without a catalog are hashed
+    if not os.path.exists(path):
+        return None
+    catalog = process_data.read_catalog(path)
+    return catalog['hash'] if catalog else process_data.hash_path(path)
+
+# Stages
+
+def get_collect_filename():
+    # Relative to the data_collection folder, the processing reads its input by this name
+    if collect_data.INCREMENTAL:
+        return collect_data.DATASET_FILENAME
+    return collect_data.get_filename(collect_data.COUNTY_CODES, collect_data.START_DATE, collect_data.END_DATE)
+
+def get_collect_output():
+    filename = collect_data.get_path('data_collection', get_collect_filename())
+    return collect_data.get_parquet_folder(filename) if collect_data.STORAGE_BACKEND == 'parquet' else filename
+
+def get_collect_params():
+    return {'countries': collect_data.COUNTY_CODES, 'start': collect_data.START_DATE, 'end': collect_data.END_DATE,
+            'transport': collect_data.TRANSPORT, 'storage_backend': collect_data.STORAGE_BACKEND,
+            'incremental': collect_data.INCREMENTAL}
+
+def is_collected():
+    # Only a collection without missing chunks is cached, the failed chunks and the prices
+    # that were not published yet are downloaded by the next run
+    filename = collect_data.get_path('data_collection', get_collect_filename())
+    if collect_data.is_legacy_file(filename):
+        return True
+    engine = collect_data.get_engine(filename)
+    start_tz = pd.Timestamp(collect_data.START_DATE, tz='UTC')
+    end_tz = pd.Timestamp(collect_data.END_DATE, tz='UTC')
+    return not any(collect_data.find_gaps(start_tz, end_tz, collect_data.get_collected_ranges(engine, country_code))
+                   for country_code in collect_data.COUNTY_CODES)
+
+def get_process_params():
+    # Only the settings that change the output, the parallel and streaming processing give the same result
+    return {'metrics': process_data.METRICS, 'families': process_data.FAMILIES, 'block_rows': process_data.BLOCK_ROWS,
+            'lazy_metrics': process_data.LAZY_METRICS, 'compact_dtypes': process_data.COMPACT_DTYPES,
+            'corr_segment_rows': process_data.CORR_SEGMENT_ROWS, 'pyramid_levels': process_data.PYRAMID_LEVELS,
+            'pyramid_aggs': process_data.PYRAMID_AGGS, 'storage_backend': process_data.STORAGE_BACKEND,
+            'input_countries': process_data.INPUT_COUNTRIES, 'input_start': process_data.INPUT_START,
+            'input_end': process_data.INPUT_END}
+
+def get_process_filename(key):
+    # Every configuration has its own folder, so they are cached side by side
+    return f"data/{key[:16]}/final.sqlite"
+
+def get_process_output(key):
+    filename = process_data.get_path('data_processing', get_process_filename(key))
+    return process_data.get_parquet_folder(filename) if process_data.STORAGE_BACKEND == 'parquet' else filename
+
+def run_stage(cache, name, params, inputs, output, run, complete=None):
+    # returns the content hash of the output
+    key = get_key(name, params, inputs)
+    entry = cache.get(key)
+    if entry is not None and entry['output'] == output and get_output_hash(output) == entry['hash']:
+        print(f"{name}: up to date in {output}")
+        return entry['hash']
+
+    print(f"{name}: running ({key[:16]})...")
+    with stage(f"pipeline_{name}"):
+        run()
+    output_hash = get_output_hash(output)
+    if output_hash is None:
+        raise ValueError(f"{name} did not write {output}")
+
+    if complete is None or complete():
+        cache[key] = {'stage': name, 'params': params, 'inputs': inputs, 'output': output, 'hash': output_hash,
+                      'created': pd.Timestamp.now(tz='UTC').isoformat()}
+        save_cache(cache)
+    return output_hash
+
+def collect(cache):
+    return run_stage(cache, 'collect', get_collect_params(), {}, get_collect_output(),
+                     collect_data.main, is_collected)
+
+def process(cache, input_hash):
+    params = get_process_params()
+    inputs = {'collect': input_hash}
+    key = get_key('process', params, inputs)
+    process_data.IN_FILENAME = get_collect_filename()
+    process_data.OUT_FILENAME = get_process_filename(key)
+    return run_stage(cache, 'process', params, inputs, get_process_output(key), process_data.main)
+
+def serve():
+    # The app is only imported here, the other stages don't need tkinter
+    import app
+    app.OUT_FILENAME = process_data.OUT_FILENAME
+    app.main()
+
+# Main code
+
+def main(last_stage='serve'):
+    if last_stage not in STAGES:
+        raise ValueError(f"Unknown stage: {last_stage}, use one of {STAGES}")
+    cache = read_cache()
+
+    input_hash = collect(cache)
+    if last_stage == 'collect':
+        return
+    process(cache, input_hash)
+    if last_stage == 'process':
+        return
+    serve()
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
@@ -0,0 +1,117 @@
+import os
+import sys
+import pandas as pd
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'data_collection'))
+
+import collect_data
+from fake_client import FakeEntsoePandasClient
+
+START = pd.Timestamp('2020-01-01', tz='UTC')
+END = pd.Timestamp('2020-01-08', tz='UTC')
+
+class FailingClient(FakeEntsoePandasClient):
+    # Raises the given errors one after the other, then answers
+    def __init__(self, *errors):
+        super().__init__()
+        self.errors = list(errors)
+
+    def query_day_ahead_prices(self, country_code, start, end):
+        if self.errors:
+            self.calls += 1
+            raise self.errors.pop(0)
+        return super().query_day_ahead_prices(country_code, start, end)
+
+class HTTPError(Exception):
+    # Like requests.HTTPError, the response has the status code
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.response = type('Response', (), {'status_code': status_code})()
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    waits = []
+    monkeypatch.setattr(collect_data.time, 'sleep', waits.append)
+    return waits
+
+@pytest.mark.parametrize('error', [ConnectionError('reset'), TimeoutError('timed out'), HTTPError(429), HTTPError(503)])
+def test_transient_error_is_retried(sleeps, error):
+    client = FailingClient(error, error)
+    df = collect_data.run_querry_with_retries('FR', client, START, END, max_retries=3, backoff=1.0)
+    assert len(df) == 7*24 and client.calls == 3
+    assert sleeps == [1.0, 2.0]
+
+@pytest.mark.parametrize('error', [ValueError('bad parameters'), LookupError('not in the replay cache'), HTTPError(400)])
+def test_other_errors_fail_at_once(sleeps, error):
+    client = FailingClient(error)
+    assert collect_data.run_querry_with_retries('FR', client, START, END, max_retries=3) is None
+    assert client.calls == 1 and sleeps == []
+
+def test_retries_run_out(sleeps):
+    client = FailingClient(*[ConnectionError('reset')] * 3)
+    assert collect_data.run_querry_with_retries('FR', client, START, END, max_retries=2, backoff=0.5) is None
+    assert client.calls == 3 and sleeps == [0.5, 1.0]
+
+def test_failed_chunks_are_reported(monkeypatch, tmp_path, sleeps, capsys):
+    monkeypatch.setattr(collect_data, 'STORAGE_BACKEND', 'sqlite')
+    client = FakeEntsoePandasClient(fail_countries=['NL'])
+    rows = collect_data.collect_missing(client, str(tmp_path / 'prices.sqlite'), ['FR', 'NL'], '2020-01-01', '2020-03-01',
+                                        max_workers=1, requests_per_second=None)
+    out = capsys.readouterr().out
+    assert rows == 60*24
+    assert '2 of 4 chunks failed' in out and 'Data saved' not in out
+
+def test_rate_limiter_spaces_out_requests(monkeypatch, sleeps):
+    now = [100.0]
+    monkeypatch.setattr(collect_data.time, 'monotonic', lambda: now[0])
+    limiter = collect_data.RateLimiter(rate=10)
+    for _ in range(3):
+        limiter.wait()
+    assert sleeps == pytest.approx([0.1, 0.2])
+
+    # an idle period does not allow a burst afterwards
+    now[0] += 5.0
+    sleeps.clear()
+    limiter.wait()
+    limiter.wait()
+    assert sleeps == pytest.approx([0.1])
+
+def test_rate_limiter_without_rate(sleeps):
+    limiter = collect_data.RateLimiter(rate=None)
+    for _ in range(3):
+        limiter.wait()
+    assert sleeps == []
+
+def ts(day):
+    return pd.Timestamp(f'2020-01-{day:02d}', tz='UTC')
+
+def test_find_gaps():
+    ranges = [(ts(2), ts(4)), (ts(6), ts(7)), (ts(9), ts(12))]
+    assert collect_data.find_gaps(ts(1), ts(10), ranges) == [(ts(1), ts(2)), (ts(4), ts(6)), (ts(7), ts(9))]
+    assert collect_data.find_gaps(ts(3), ts(4), ranges) == []
+    assert collect_data.find_gaps(ts(12), ts(15), ranges) == [(ts(12), ts(15))]
+    assert collect_data.find_gaps(ts(1), ts(5), []) == [(ts(1), ts(5))]
+
+def test_merge_ranges():
+    # touching and overlapping ranges are merged, in any order
+    ranges = [(ts(6), ts(8)), (ts(1), ts(3)), (ts(3), ts(4)), (ts(7), ts(10)), (ts(12), ts(13))]
+    assert collect_data.merge_ranges(ranges) == [(ts(1), ts(4)), (ts(6), ts(10)), (ts(12), ts(13))]
+    assert collect_data.merge_ranges([]) == []
+
+@pytest.mark.parametrize('freq', ['h', '15min'])
+def test_collected_range_ends_after_the_last_price(monkeypatch, tmp_path, freq):
+    monkeypatch.setattr(collect_data, 'STORAGE_BACKEND', 'sqlite')
+    engine = collect_data.get_engine(str(tmp_path / 'prices.sqlite'))
+    collect_data.create_tables(engine)
+    client = FakeEntsoePandasClient(freq=freq)
+    # the prices of the chunk are only published until 10:00, the last one is at 9:00 or 9:45
+    published = pd.Timestamp('2020-01-01 10:00', tz='UTC')
+    collect_data.save_chunk(engine, 'FR', START, END, collect_data.run_querry('FR', client, START, published))
+    assert collect_data.get_collected_ranges(engine, 'FR') == [(START, published)]
+
+    # a complete response covers the whole chunk
+    chunk_start = pd.Timestamp('2020-01-03', tz='UTC')
+    collect_data.save_chunk(engine, 'FR', chunk_start, END, collect_data.run_querry('FR', client, chunk_start, END))
+    assert collect_data.get_collected_ranges(engine, 'FR')[-1] == (chunk_start, END)
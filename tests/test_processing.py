@@ -0,0 +1,228 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+# The incremental, streaming and parallel processing have to give the same output as processing everything at once
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for folder in ('data_collection', 'data_processing'):
+    sys.path.insert(0, os.path.join(ROOT_DIR, folder))
+
+import collect_data
+import process_data
+from corr_index import load_corr_index
+from fake_client import FakeEntsoePandasClient
+
+TIME_TABLES = ['df', 'df_daily', 'df_weekly', 'df_monthly']
+
+class FlakyClient(FakeEntsoePandasClient):
+    # Fails the requests of one (country, chunk start)
+    def __init__(self, fail=None):
+        super().__init__()
+        self.fail = fail
+
+    def query_day_ahead_prices(self, country_code, start, end):
+        if (country_code, start) == self.fail:
+            raise ConnectionError(f"Fake failure for {country_code} {start}")
+        return super().query_day_ahead_prices(country_code, start, end)
+
+@pytest.fixture(autouse=True)
+def settings(monkeypatch):
+    # small blocks and chunks, so the data has several of them
+    monkeypatch.setattr(process_data, 'STORAGE_BACKEND', 'sqlite')
+    monkeypatch.setattr(process_data, 'BLOCK_ROWS', 30*24)
+    monkeypatch.setattr(process_data, 'CHUNK_BLOCKS', 1)
+    monkeypatch.setattr(collect_data, 'STORAGE_BACKEND', 'sqlite')
+    # no waiting between the retries of the failed chunks
+    monkeypatch.setattr(collect_data.time, 'sleep', lambda seconds: None)
+
+def collect(filename, countries, start, end, client=None):
+    collect_data.collect_missing(client or FakeEntsoePandasClient(), str(filename), countries, start, end,
+                                 max_workers=2, requests_per_second=None)
+
+def process(monkeypatch, in_filename, out_filename, **settings):
+    monkeypatch.setattr(process_data, 'IN_FILENAME', str(in_filename))
+    monkeypatch.setattr(process_data, 'OUT_FILENAME', str(out_filename))
+    settings = {'INCREMENTAL': True, 'STREAMING': False, 'PARALLEL_WORKERS': 1, **settings}
+    for name, value in settings.items():
+        monkeypatch.setattr(process_data, name, value)
+    process_data.main()
+
+def assert_same_output(filename, expected_filename):
+    for table in TIME_TABLES:
+        pd.testing.assert_frame_equal(process_data.read_sqlite(str(filename), table),
+                                      process_data.read_sqlite(str(expected_filename), table), check_exact=True)
+    # the correlation sums are added up in a different order
+    corr = pd.read_sql_table('corr', process_data.get_engine(str(filename)), index_col='index')
+    expected = pd.read_sql_table('corr', process_data.get_engine(str(expected_filename)), index_col='index')
+    pd.testing.assert_frame_equal(corr, expected, rtol=1e-9)
+
+def process_full(monkeypatch, in_filename, out_filename, **settings):
+    # The reference: everything processed at once into a new output
+    if os.path.exists(out_filename):
+        os.remove(out_filename)
+    process(monkeypatch, in_filename, out_filename, INCREMENTAL=False, **settings)
+
+@pytest.mark.parametrize('settings', [{}, {'STREAMING': True}, {'PARALLEL_WORKERS': 2}], ids=['blocks', 'streaming', 'parallel'])
+def test_same_as_full_run(monkeypatch, tmp_path, settings):
+    prices = tmp_path / 'prices.sqlite'
+    collect(prices, ['FR', 'NL', 'BE'], '2020-01-01', '2020-04-15')
+    process_full(monkeypatch, prices, tmp_path / 'full.sqlite')
+
+    process(monkeypatch, prices, tmp_path / 'out.sqlite', **settings)
+    assert_same_output(tmp_path / 'out.sqlite', tmp_path / 'full.sqlite')
+
+@pytest.mark.parametrize('settings', [{}, {'STREAMING': True}, {'PARALLEL_WORKERS': 2}], ids=['blocks', 'streaming', 'parallel'])
+def test_incremental_new_rows(monkeypatch, tmp_path, settings):
+    prices = tmp_path / 'prices.sqlite'
+    collect(prices, ['FR', 'NL'], '2020-01-01', '2020-02-20')
+    process(monkeypatch, prices, tmp_path / 'out.sqlite', **settings)
+    collect(prices, ['FR', 'NL'], '2020-01-01', '2020-04-15')
+    process(monkeypatch, prices, tmp_path / 'out.sqlite', **settings)
+
+    process_full(monkeypatch, prices, tmp_path / 'full.sqlite')
+    assert_same_output(tmp_path / 'out.sqlite', tmp_path / 'full.sqlite')
+
+def test_incremental_new_country(monkeypatch, tmp_path):
+    prices = tmp_path / 'prices.sqlite'
+    collect(prices, ['FR', 'NL'], '2020-01-01', '2020-03-01')
+    process(monkeypatch, prices, tmp_path / 'out.sqlite')
+
+    # the same dates for a new country, then more dates for all of them
+    collect(prices, ['BE'], '2020-01-01', '2020-03-01')
+    process(monkeypatch, prices, tmp_path / 'out.sqlite')
+    process_full(monkeypatch, prices, tmp_path / 'full.sqlite')
+    assert_same_output(tmp_path / 'out.sqlite', tmp_path / 'full.sqlite')
+
+    collect(prices, ['FR', 'NL', 'BE'], '2020-01-01', '2020-04-01')
+    process(monkeypatch, prices, tmp_path / 'out.sqlite')
+    process_full(monkeypatch, prices, tmp_path / 'full.sqlite')
+    assert_same_output(tmp_path / 'out.sqlite', tmp_path / 'full.sqlite')
+
+def test_incremental_retried_chunk(monkeypatch, tmp_path):
+    # the February chunk of FR fails, it is collected by the next run together with the new rows
+    prices = tmp_path / 'prices.sqlite'
+    fail = ('FR', pd.Timestamp('2020-02-01', tz='UTC'))
+    collect(prices, ['FR', 'NL'], '2020-01-01', '2020-03-01', FlakyClient(fail))
+    process(monkeypatch, prices, tmp_path / 'out.sqlite')
+    assert process_data.read_sqlite(str(tmp_path / 'out.sqlite'), 'df', ['FR'], '2020-02-01', '2020-02-29')['FR'].isna().all()
+
+    collect(prices, ['FR', 'NL'], '2020-01-01', '2020-03-15')
+    process(monkeypatch, prices, tmp_path / 'out.sqlite')
+    process_full(monkeypatch, prices, tmp_path / 'full.sqlite')
+    assert_same_output(tmp_path / 'out.sqlite', tmp_path / 'full.sqlite')
+
+def test_incremental_changed_price(monkeypatch, tmp_path):
+    prices = tmp_path / 'prices.sqlite'
+    collect(prices, ['FR', 'NL'], '2020-01-01', '2020-03-01')
+    process(monkeypatch, prices, tmp_path / 'out.sqlite')
+
+    # an earlier price is overwritten, the number of prices stays the same
+    with collect_data.get_engine(str(prices)).begin() as conn:
+        df = pd.DataFrame({'Datetime': [pd.Timestamp('2020-01-15 12:00', tz='UTC')], 'FR': [np.float64(1234.5)]})
+        collect_data.upsert_prices(conn, df, 'FR')
+    collect(prices, ['FR', 'NL'], '2020-01-01', '2020-03-15')
+    process(monkeypatch, prices, tmp_path / 'out.sqlite')
+    process_full(monkeypatch, prices, tmp_path / 'full.sqlite')
+    assert_same_output(tmp_path / 'out.sqlite', tmp_path / 'full.sqlite')
+
+def test_streaming_empty_input(monkeypatch, tmp_path):
+    prices = tmp_path / 'prices.sqlite'
+    collect(prices, ['FR'], '2020-01-01', '2020-02-01', FakeEntsoePandasClient(fail_countries=['FR']))
+    process(monkeypatch, prices, tmp_path / 'out.sqlite', STREAMING=True)
+    assert not os.path.exists(tmp_path / 'out.sqlite')
+
+def test_corr_with_zero_price(monkeypatch, tmp_path):
+    # the percentage changes after a zero price are infinite, the saved correlation leaves them out like df.corr()
+    prices = tmp_path / 'prices.sqlite'
+    collect(prices, ['FR', 'NL'], '2020-01-01', '2020-03-01')
+    with collect_data.get_engine(str(prices)).begin() as conn:
+        df = pd.DataFrame({'Datetime': [pd.Timestamp('2020-01-15 12:00', tz='UTC')], 'FR': [0.0]})
+        collect_data.upsert_prices(conn, df, 'FR')
+    process(monkeypatch, prices, tmp_path / 'out.sqlite')
+
+    df = process_data.read_sqlite(str(tmp_path / 'out.sqlite'), 'df')
+    assert np.isinf(df['FR_daily_pct_change']).any()
+    corr = pd.read_sql_table('corr', process_data.get_engine(str(tmp_path / 'out.sqlite')), index_col='index')
+    corr.index.name = None
+    pd.testing.assert_frame_equal(corr, process_data.correlation_matrix(df), rtol=1e-9)
+
+def test_corr_index_range_after_incremental_run(monkeypatch, tmp_path):
+    # the checkpoints of the first run are memory mapped by the second, which appends its own
+    prices = tmp_path / 'prices.sqlite'
+    out = str(tmp_path / 'out.sqlite')
+    collect(prices, ['FR', 'NL'], '2020-01-01', '2020-02-20')
+    process(monkeypatch, prices, out)
+    collect(prices, ['FR', 'NL'], '2020-01-01', '2020-04-15')
+    process(monkeypatch, prices, out)
+
+    index = load_corr_index(process_data.get_corr_index_filename(out))
+    assert isinstance(index.saved, np.memmap) and not index.added
+    df = process_data.read_sqlite(out, 'df')
+    columns = ['FR', 'NL', 'FR_daily_pct_change']
+    start, end = pd.Timestamp('2020-01-10 05:00'), pd.Timestamp('2020-03-20 17:00')
+    corr = index.corr(columns, start, end, lambda columns, s, e: df.loc[s:e, columns])
+    pd.testing.assert_frame_equal(corr, df.loc[start:end, columns].corr(), rtol=1e-9)
+
+def test_streaming_keeps_one_chunk_of_checkpoints(monkeypatch, tmp_path):
+    # the checkpoints of a chunk are in the index file before the next chunk is processed
+    prices = tmp_path / 'prices.sqlite'
+    collect(prices, ['FR', 'NL'], '2020-01-01', '2020-06-01')
+    added = []
+    update_corr_index = process_data.update_corr_index
+    def update(index, df):
+        added.append(0 if index is None else len(index.added))
+        return update_corr_index(index, df)
+    monkeypatch.setattr(process_data, 'update_corr_index', update)
+    process(monkeypatch, prices, tmp_path / 'out.sqlite', STREAMING=True, CORR_SEGMENT_ROWS=7*24)
+    assert len(added) > 2 and not any(added)
+
+    index = load_corr_index(process_data.get_corr_index_filename(str(tmp_path / 'out.sqlite')))
+    process_full(monkeypatch, prices, tmp_path / 'full.sqlite', CORR_SEGMENT_ROWS=7*24)
+    full = load_corr_index(process_data.get_corr_index_filename(str(tmp_path / 'full.sqlite')))
+    assert index.checkpoints == full.checkpoints > 10
+    df = process_data.read_sqlite(str(tmp_path / 'full.sqlite'), 'df')
+    get_frame = lambda columns, start, end: df.loc[start:end, columns]
+    start, end = pd.Timestamp('2020-02-03 07:00'), pd.Timestamp('2020-04-20 19:00')
+    pd.testing.assert_frame_equal(index.corr(['FR', 'NL'], start, end, get_frame), full.corr(['FR', 'NL'], start, end, get_frame), rtol=1e-9)
+
+def test_lazy_metrics_same_as_saved(monkeypatch, tmp_path):
+    from metric_store import LazyMetrics
+    prices = tmp_path / 'prices.sqlite'
+    collect(prices, ['FR', 'NL'], '2020-01-01', '2020-04-15')
+    process_full(monkeypatch, prices, tmp_path / 'full.sqlite')
+    df = process_data.read_sqlite(str(tmp_path / 'full.sqlite'), 'df')
+
+    # a small cache, so blocks are dropped and computed again
+    lazy = LazyMetrics(df[['FR', 'NL']], max_bytes=2**16, persist_folder=str(tmp_path / 'metric_cache'), dataset_hash='test')
+    columns = [col for col in df.columns if col.split('_', 1)[-1] in process_data.METRIC_REGISTRY]
+    assert len(columns) > 10
+    pd.testing.assert_frame_equal(lazy.get_frame(columns), df[columns], check_freq=False, check_names=False, rtol=1e-9)
+    start, end = pd.Timestamp('2020-02-10 05:00'), pd.Timestamp('2020-03-03 17:00')
+    pd.testing.assert_frame_equal(lazy.get_frame(columns, start, end), df.loc[start:end, columns],
+                                  check_freq=False, check_names=False, rtol=1e-9)
+    assert lazy.nbytes <= 2**16 or len(lazy.blocks) == 1
+
+    # the complete blocks are read from the saved files
+    lazy = LazyMetrics(df[['FR', 'NL']], persist_folder=str(tmp_path / 'metric_cache'), dataset_hash='test')
+    pd.testing.assert_frame_equal(lazy.get_frame(columns), df[columns], check_freq=False, check_names=False, rtol=1e-9)
+
+def test_live_series_same_as_rolling_stats():
+    from live_metrics import LiveSeries
+    from fake_client import synthetic_prices
+    prices = synthetic_prices('FR', pd.Timestamp('2020-01-01'), pd.Timestamp('2020-03-01'), gap_fraction=0.1)
+    prices = prices.reindex(pd.date_range('2020-01-01', '2020-03-01', freq='h', inclusive='left'))
+    prices.iloc[[5, 100, 101, 102]] = np.nan
+    assert prices.isna().any()
+    df = pd.DataFrame({'FR': prices.to_numpy()}, index=pd.DatetimeIndex(prices.index, name='Datetime'))
+
+    # fewer rows than the input, so the buffers wrap around
+    live = LiveSeries('FR', capacity=30*24)
+    assert live.extend(prices) == len(prices)
+    assert not live.extend(prices.iloc[-10:])
+    frame = live.frame()
+    expected = process_data.rolling_stats(df, ['FR'])[live.columns].iloc[-30*24:]
+    assert len(live.columns) > 5
+    pd.testing.assert_frame_equal(frame, expected, check_freq=False, rtol=1e-7, atol=1e-9)
@@ -0,0 +1,65 @@
+import os
+import sys
+import time
+import pandas as pd
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'data_collection'))
+
+import collect_data
+from fake_client import FakeEntsoePandasClient
+from transport import ResponseCache, CachingClient
+
+START = pd.Timestamp('2020-01-01', tz='UTC')
+END = pd.Timestamp('2020-02-01', tz='UTC')
+
+def set_used(cache, key, seconds_ago):
+    # access (last use) and modification (creation) time of a cached response
+    when = time.time() - seconds_ago
+    os.utime(cache.get_path(key), (when, when))
+
+def test_record_then_replay(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache'))
+    client = FakeEntsoePandasClient()
+    recording = CachingClient(client, cache, mode='record')
+    series = recording.query_day_ahead_prices('FR', START, END)
+    assert client.calls == 1
+    # the second request of the same range is answered from the cache
+    pd.testing.assert_series_equal(recording.query_day_ahead_prices('FR', START, END), series)
+    assert client.calls == 1 and cache.hits == 1
+
+    replay = CachingClient(None, ResponseCache(str(tmp_path / 'cache')), mode='replay')
+    pd.testing.assert_series_equal(replay.query_day_ahead_prices('FR', START, END), series)
+
+def test_replay_miss_fails_without_retries(monkeypatch, tmp_path):
+    sleeps = []
+    monkeypatch.setattr(collect_data.time, 'sleep', sleeps.append)
+    replay = CachingClient(None, ResponseCache(str(tmp_path / 'cache')), mode='replay')
+    with pytest.raises(LookupError):
+        replay.query_day_ahead_prices('FR', START, END)
+    assert collect_data.run_querry_with_retries('FR', replay, START, END) is None
+    assert sleeps == []
+
+def test_ttl_expiry(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache'), ttl=60)
+    key = cache.get_key('FR', START, END)
+    cache.put(key, 'response')
+    assert cache.get(key) == 'response'
+    set_used(cache, key, 120)
+    assert cache.get(key) is None
+    assert not os.path.exists(cache.get_path(key))
+
+def test_lru_eviction(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache'))
+    keys = [cache.get_key(country, START, END) for country in ('FR', 'NL', 'BE')]
+    cache.put(keys[0], 'x' * 1000)
+    size = os.path.getsize(cache.get_path(keys[0]))
+    cache.put(keys[1], 'x' * 1000)
+    set_used(cache, keys[0], 30)
+    set_used(cache, keys[1], 20)
+    # FR is read again, NL is now the least recently used and is dropped for BE
+    assert cache.get(keys[0]) is not None
+    cache.max_bytes = 2 * size
+    cache.put(keys[2], 'x' * 1000)
+    assert [os.path.exists(cache.get_path(key)) for key in keys] == [True, False, True]
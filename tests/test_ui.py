@@ -0,0 +1,71 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'ui'))
+
+import app
+from query_cache import QueryCache, get_nbytes
+
+def test_minmax_downsample_keeps_extrema():
+    rng = np.random.default_rng(0)
+    n, width = 10_000, 100
+    x = pd.date_range('2020-01-01', periods=n, freq='h').to_numpy()
+    y = rng.normal(50, 10, n)
+    y[1234], y[5678] = 900, -900 # spikes
+    y[3000:3400] = np.nan # a gap longer than a bucket
+
+    x_down, y_down = app.minmax_downsample(x, y, width)
+    assert len(y_down) <= 2 * app.POINTS_PER_PIXEL * width
+    assert (np.diff(x_down) > np.timedelta64(0)).all()
+    assert 900 in y_down and -900 in y_down
+    # the min and the max of every bucket are kept with their own time
+    size = -(-n // (width * app.POINTS_PER_PIXEL // 2))
+    kept = dict(zip(x_down, y_down))
+    for first in range(0, n, size):
+        bucket = y[first:first + size]
+        if np.isnan(bucket).all():
+            assert np.isnan(kept[x[first]])
+            continue
+        for i in (np.nanargmin(bucket), np.nanargmax(bucket)):
+            assert kept[x[first + i]] == bucket[i]
+
+def test_minmax_downsample_short_line():
+    x, y = np.arange(10), np.arange(10.0)
+    x_down, y_down = app.minmax_downsample(x, y, 100)
+    assert x_down is x and y_down is y
+
+def test_query_cache_lru_and_memory():
+    frame = lambda value: pd.DataFrame({'FR': np.full(100, float(value))})
+    nbytes = get_nbytes(frame(0))
+    cache = QueryCache(max_bytes=2 * nbytes)
+    computed = []
+    def get(key):
+        return cache.get(key, lambda: computed.append(key) or frame(key))
+
+    get(1), get(2)
+    assert cache.nbytes == 2 * nbytes
+    get(1) # 1 is now used more recently than 2
+    get(3)
+    assert list(cache.items) == [1, 3] and cache.nbytes == 2 * nbytes
+    assert get(1)['FR'].iloc[0] == 1
+    get(2)
+    assert computed == [1, 2, 3, 2]
+    assert cache.stats() == {'hits': 2, 'misses': 4, 'results': 2, 'bytes': 2 * nbytes}
+
+    # a result bigger than the cache is returned, but not kept
+    big = pd.DataFrame({'FR': np.zeros(1000)})
+    assert cache.get('big', lambda: big) is big
+    assert 'big' not in cache.items and cache.nbytes == 2 * nbytes
+
+def test_query_cache_dataset_hash():
+    cache = QueryCache()
+    cache.check_hash('a')
+    cache.get('key', lambda: pd.Series([1.0]))
+    cache.check_hash('a')
+    assert 'key' in cache.items
+    cache.check_hash('b')
+    assert not cache.items and cache.nbytes == 0 and cache.dataset_hash == 'b'
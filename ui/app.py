@@ -1,49 +1,110 @@
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
-from sqlalchemy import create_engine, inspect
+from sqlalchemy import create_engine, inspect, text
 
 import tkinter as tk
-from tkinter import Listbox, MULTIPLE
+from tkinter import Listbox, MULTIPLE, ttk
 from tkcalendar import DateEntry
 
 from matplotlib.figure import Figure
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+from matplotlib.dates import num2date
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+# the output is read with the processing's own code
+sys.path.append(os.path.join(ROOT_DIR, 'data_processing'))
+from instrumentation import traced
+from query_cache import QueryCache
+from process_data import (read_sqlite, read_parquet, get_parquet_folder, read_catalog,
+                          apply_dtypes, get_corr_index_filename)
+from corr_index import load_corr_index
+from metric_store import LazyMetrics
+from live_metrics import LiveSeries
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
 
 # Global variables
 
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sqlite') # 'sqlite' or 'parquet' (needs pyarrow)
+OUT_FILENAME = 'data/final.sqlite' # Processed dataset in the data_processing folder
+PARQUET_FOLDER = None # Folder of the parquet dataset, the plotted columns are read from it on demand
+SQLITE_FILE = None # The SQLite output, the plotted rows and columns are queried from it on demand
+LAZY = None # LazyMetrics of an output processed with LAZY_METRICS, computes the derived columns on demand
+LAZY_CACHE_MB = 256 # Size of the computed blocks kept in memory
+CORR_INDEX = None # Cumulative sums of the processing, the correlation matrix is computed for the selected dates from it
+PYRAMID_LEVELS = [('df_monthly', 30*24), ('df_weekly', 7*24), ('df_daily', 24)] # Aggregated tables and their hours per row
+LEVEL_COLUMNS = {} # Columns of every aggregated table in the output
+SAVED_DTYPES = {} # dtypes of the processed columns from the catalog, e.g. float32 and int8 with COMPACT_DTYPES
+INCREMENTAL_RENDERING = True # Keep the lines and the correlation image and only update their data (False = clear and plot again)
+QUERY_CACHE_MB = 128 # Size of the frames and correlation matrices of the recent plots kept in memory
+QUERY_CACHE = QueryCache(QUERY_CACHE_MB * 2**20) # Keyed by (columns, start, end, resolution), cleared when the output changes
+POINTS_PER_PIXEL = 2 # The hourly lines are reduced to the min and max point of every horizontal pixel
+
 DF_Y_TYPES = []
 DF_Y_COUNTRIES = []
 DF_Y_COLS = []
 
-DF = None
+DF_COLUMNS = []
 CORR_DF = None
 
 AX_DF = None
 FIG_DF = None
 CANVAS_DF = None
+PLOT_DF = None # Hourly rows of the current plot, they are reduced again for the visible range when zooming
+PLOT_LINES = {} # Line of every column of the current plot
+PLOT_BANDS = {} # Min-max band of every column when plotting from an aggregated table
+PLOT_COLUMNS = [] # Columns of the legend
+PLOT_AXES = None # Axes of the lines above
+PLOT_LEVEL = None # Aggregated table of the current plot, None = hourly rows
+PLOT_ZOOM = None # (start, end) of the rows read for the zoomed range, None = the rows of the selected period
 
 AX_CORR = None
 FIG_CORR = None
 CANVAS_CORR = None
+CORR_IMAGE = None # Image of the correlation matrix, updated in place while the columns don't change
+CORR_LABELS = [] # Columns of CORR_IMAGE
+CORR_BACKGROUND = None # The correlation axes without the image, saved after every full draw for blitting
+CORR_CANVAS_ID = None # (canvas, id) of the draw_event callback
 
 START = None
 END = None
 
+WORKER = None # One background thread reads the data and prepares the plots, so the window stays responsive
+POLL_MS = 50 # The main thread checks the background work this often
+PENDING = 0 # Number of unfinished background jobs
+REQUEST_ID = 0 # Number of the latest plot update, the results of older ones are dropped
+STATUS = None # Label and progress bar of the background loading
+ROOT = None # The window, the rows of a zoomed range are read in the background with it
+
+# Live mode: the plot follows a price feed, the derived columns of the new prices are updated point by point
+LIVE_TRANSPORT = os.environ.get('LIVE_TRANSPORT', 'fake') # 'fake' = synthetic prices after the last date of the output, 'live' = ENTSO-E API (ENTSOE_API_KEY)
+LIVE_POLL_MS = 1000 if LIVE_TRANSPORT == 'fake' else 15*60*1000 # The feed is asked for new prices this often
+LIVE_HOURS_PER_POLL = 1 # Hours the clock of the fake feed moves forward at every poll
+LIVE_CAPACITY = 60*24 # Rows of every country kept for the live plot, the memory doesn't grow with the uptime
+LIVE = {} # LiveSeries of every country (see live_metrics.py)
+LIVE_CLIENT = None
+LIVE_CLOCK = None # The fake feed has the prices before this time
+LIVE_RUNNING = False
+
 # Helper functions
 
 def get_path(foldername, filename):
-    running_dir = os.getcwd()
-    parent_dir = os.path.dirname(running_dir)
-    full_filename = os.path.join(parent_dir, foldername, filename)
+    # Same files as the other scripts find, whatever the working directory is
+    full_filename = os.path.join(ROOT_DIR, foldername, filename)
     full_filename = full_filename.replace('\\', '/')
     full_filename = full_filename[0].upper() + full_filename[1:]
 
     return full_filename
 
 def get_out_filename():
-    filename = 'data/final.sqlite'
-    full_filename = get_path('data_processing', filename)
+    full_filename = get_path('data_processing', OUT_FILENAME)
     return full_filename
 
 def get_engine(filename):
@@ -64,6 +125,7 @@ def get_table_names(engine):
         raise ValueError('Error getting table names')
     return table_names
 
+@traced()
 def get_data(engine, table_name):
     try:
         df = pd.read_sql_table(table_name, engine)
@@ -72,12 +134,123 @@ def get_data(engine, table_name):
         raise ValueError('Error getting df')
     return df
 
-def read_in_dfs(engine, table_names):
-    dfs = {}
-    for table_name in table_names:
-        df = get_data(engine, table_name)
-        dfs[table_name] = df
-    return dfs
+def get_parquet_columns(folder):
+    schema = pq.ParquetDataset(folder).schema
+    return [name for name in schema.names if name not in ('Datetime', 'month')]
+
+def add_collection_path():
+    # The live mode queries the prices with the collection's clients
+    collection_dir = get_path('data_collection', '')
+    if collection_dir not in sys.path:
+        sys.path.append(collection_dir)
+
+def get_corr_index(filename):
+    return load_corr_index(get_corr_index_filename(filename))
+
+def get_lazy_metrics(prices, catalog):
+    # The blocks of the derived columns are also saved next to the output
+    return LazyMetrics(prices, max_bytes=LAZY_CACHE_MB * 2**20,
+                       persist_folder=get_path('data_processing', 'data/metric_cache'), dataset_hash=catalog['hash'])
+
+def get_sqlite_columns(engine, table_name):
+    return [col['name'] for col in inspect(engine).get_columns(table_name) if col['name'] != 'ts']
+
+@traced()
+def read_table(table_name, columns=None, start=None, end=None):
+    # Rows between start and end of the given columns of a time indexed output table, indexed by Datetime
+    if PARQUET_FOLDER is None:
+        return apply_dtypes(read_sqlite(SQLITE_FILE, table_name, columns, start, end), SAVED_DTYPES)
+    columns = ['Datetime'] + list(columns) if columns is not None else None
+    df = read_parquet(os.path.join(PARQUET_FOLDER, table_name), columns=columns, start=start, end=end)
+    return apply_dtypes(df.drop(columns=['month'], errors='ignore').set_index('Datetime').sort_index(), SAVED_DTYPES)
+
+def get_frame(columns, start, end):
+    # Rows between start and end of the given columns, indexed by Datetime
+    if LAZY is not None:
+        return LAZY.get_frame(columns, start, end)
+    return read_table('df', columns, start, end)
+
+def choose_level(columns, start, end, width):
+    # The coarsest aggregated table that still has a point for every pixel of the plot, None = the hourly rows
+    if start is None or end is None:
+        return None
+    hours = (pd.Timestamp(end) - pd.Timestamp(start)) / pd.Timedelta(hours=1)
+    for table, period_hours in PYRAMID_LEVELS:
+        names = [f"{col}__mean" for col in columns]
+        if table in LEVEL_COLUMNS and all(name in LEVEL_COLUMNS[table] for name in names) and hours / period_hours >= width:
+            return table
+    return None
+
+@traced()
+def minmax_downsample(x, y, width):
+    # The min and max point of every bucket of consecutive rows, in time order, so the spikes stay visible
+    # (POINTS_PER_PIXEL points for every pixel of the width). A bucket without values keeps one NaN point, so the gaps stay gaps
+    n = len(y)
+    if width <= 0 or n <= POINTS_PER_PIXEL * width:
+        return x, y
+    size = -(-n // max(width * POINTS_PER_PIXEL // 2, 1))
+    count = -(-n // size)
+    grid = np.full(count * size, np.nan)
+    grid[:n] = y
+    grid = grid.reshape(count, size)
+    valid = ~np.isnan(grid)
+    first = np.arange(count) * size
+    lowest = first + np.argmin(np.where(valid, grid, np.inf), axis=1)
+    highest = first + np.argmax(np.where(valid, grid, -np.inf), axis=1)
+    empty = ~valid.any(axis=1)
+    lowest[empty] = first[empty]
+    highest[empty] = first[empty]
+    idx = np.unique(np.concatenate([lowest, highest]))
+    return x[idx], y[idx]
+
+def downsample_column(df, col, width, xlim=None):
+    # The rows of the column inside xlim (and one more on both sides, so the line reaches the edges), reduced to the width in pixels
+    if xlim is not None:
+        start, end = [pd.Timestamp(num2date(lim)).tz_localize(None) for lim in xlim]
+        first = max(df.index.searchsorted(start) - 1, 0)
+        df = df.iloc[first:df.index.searchsorted(end, 'right') + 1]
+    return minmax_downsample(df.index.to_numpy(), df[col].to_numpy(dtype='float64'), int(width))
+
+def refine_plot(ax):
+    # Called when the x range changes (zoom or pan). The hourly lines get the points of the new range, a plot from
+    # an aggregated table (or hourly rows read for a smaller zoomed range) is read again for the visible dates,
+    # from the table choose_level picks for them
+    start, end = [pd.Timestamp(num2date(lim)).tz_localize(None) for lim in ax.get_xlim()]
+    if PLOT_DF is not None and (PLOT_ZOOM is None or PLOT_ZOOM[0] <= start and end <= PLOT_ZOOM[1]):
+        for col, line in PLOT_LINES.items():
+            line.set_data(*downsample_column(PLOT_DF, col, ax.bbox.width, ax.get_xlim()))
+        return
+    if ROOT is None or LIVE_RUNNING or ax is not PLOT_AXES or not PLOT_COLUMNS or START is None or END is None:
+        return
+
+    # only the dates of the selected period are read, and only when the rows of the plot don't have them at the
+    # resolution they need (a draw also calls this with the same limits)
+    start, end = max(start, pd.Timestamp(START)), min(end, pd.Timestamp(END))
+    first, last = PLOT_ZOOM or (pd.Timestamp(START), pd.Timestamp(END))
+    if start >= end or first <= start and end <= last and choose_level(PLOT_COLUMNS, start, end, ax.bbox.width) == PLOT_LEVEL:
+        return
+    request_id = REQUEST_ID
+    columns, xlim, width = list(PLOT_COLUMNS), ax.get_xlim(), ax.bbox.width
+
+    def done(figure_data):
+        # a newer update or zoom makes the rows obsolete
+        if request_id == REQUEST_ID and ax.get_xlim() == xlim and columns == PLOT_COLUMNS:
+            draw_zoomed(columns, *figure_data, start, end)
+
+    run_in_background(ROOT, "Loading zoomed plot...", lambda: get_figure_data(columns, start, end, width), done)
+
+def get_level_frame(table, columns, start, end):
+    # min, max and mean of the columns from an aggregated table, indexed by the start of the periods
+    names = [f"{col}__{agg}" for col in columns for agg in ('min', 'max', 'mean')]
+    return read_table(table, names, start, end)
+
+def get_dataset_hash():
+    # Content hash of the output from its catalog, the modification time of an output without one
+    path = PARQUET_FOLDER or SQLITE_FILE
+    catalog = read_catalog(path)
+    if catalog is not None:
+        return catalog['hash']
+    return str(os.path.getmtime(path)) if os.path.exists(path) else None
 
 def get_2char_columns(cols):
     return [col for col in cols if len(col) == 2]
@@ -98,11 +271,11 @@ def get_col_names(countries, col_types):
 ## GUI functions
 
 def create_ui():
-    global DF, DF_Y_COLS, DF_Y_COUNTRIES, DF_Y_TYPES
+    global DF_Y_COLS, DF_Y_COUNTRIES, DF_Y_TYPES
 
     root = tk.Tk()
     root.title("Demo app")
-    columns = DF.columns
+    columns = DF_COLUMNS
 
     # Create a Listbox for selecting TYPES and COUNTRIES
     listbox_type = Listbox(root, selectmode=MULTIPLE)
@@ -192,72 +365,224 @@ def create_figure():
     ax = fig.add_subplot(111)
     return fig, ax
 
+def create_status(root):
+    # Label and progress bar of the background loading
+    label = tk.Label(root, text="Loading data...")
+    label.grid(row=4, column=0, columnspan=3, sticky='w')
+    progress = ttk.Progressbar(root, mode='indeterminate', length=200)
+    progress.grid(row=4, column=3, columnspan=2)
+    return label, progress
+
+def set_status(text):
+    label, progress = STATUS
+    label.config(text=text)
+    if PENDING > 0:
+        progress.start(POLL_MS)
+    else:
+        progress.stop()
+
+def run_in_background(root, message, work, done):
+    # work() runs on the worker thread, done(result) on the Tk main thread. Tk is only used from the main thread,
+    # it polls the result with root.after, so the window keeps handling events while the worker reads the data
+    global PENDING
+    PENDING += 1
+    set_status(message)
+    future = WORKER.submit(work)
+
+    def check():
+        global PENDING
+        if not future.done():
+            root.after(POLL_MS, check)
+            return
+        PENDING -= 1
+        try:
+            result = future.result()
+            set_status("Ready" if PENDING == 0 else message)
+            done(result)
+        except Exception as e:
+            print(f"Error: {e}")
+            set_status(f"Error: {e}")
+
+    root.after(POLL_MS, check)
+
+@traced()
+def get_figure_data(columns, start, end, width):
+    # (aggregated table or None, rows to plot), runs on the worker thread. The width only chooses the table,
+    # so the same columns and dates at the same resolution are read once
+    level = choose_level(columns, start, end, width)
+    QUERY_CACHE.check_hash(get_dataset_hash())
+    if level is not None:
+        return QUERY_CACHE.get(('figure', tuple(columns), start, end, level), lambda: (level, get_level_frame(level, columns, start, end)))
+    return QUERY_CACHE.get(('figure', tuple(columns), start, end, None), lambda: (None, get_frame(columns, start, end)))
+
+def reset_figure():
+    # Empty axes for a new kind of plot, the lines and bands are added by draw_figure
+    global PLOT_AXES, PLOT_LEVEL
+    AX_DF.clear()
+    PLOT_LINES.clear()
+    PLOT_BANDS.clear()
+    PLOT_COLUMNS.clear()
+    PLOT_AXES, PLOT_LEVEL = AX_DF, None
+
+    # add xlabel, ylabel and title, and rotate the x ticks (also the ones added later)
+    AX_DF.set_xlabel('Datetime')
+    AX_DF.set_ylabel('Y')
+    AX_DF.set_title('Demo plot')
+    AX_DF.tick_params(axis='x', labelrotation=20)
+    AX_DF.callbacks.connect('xlim_changed', refine_plot)
+
+@traced()
+def draw_figure(columns, level, df):
+    # With INCREMENTAL_RENDERING the line of every column is kept, a new date range only replaces their data,
+    # and lines are only added or removed when the selection changes
+    global PLOT_DF, PLOT_LEVEL, PLOT_ZOOM
+    if not INCREMENTAL_RENDERING or PLOT_AXES is not AX_DF or (level is None) != (PLOT_LEVEL is None):
+        reset_figure()
+    PLOT_LEVEL = level
+    PLOT_DF = None
+    PLOT_ZOOM = None
+
+    for col in [col for col in PLOT_LINES if col not in columns]:
+        PLOT_LINES.pop(col).remove()
+    for col in [col for col in PLOT_BANDS if col not in columns or level is None]:
+        PLOT_BANDS.pop(col).remove()
+
+    # long periods are plotted from an aggregated table, the mean with the min-max range around it
+    # the hourly rows have about POINTS_PER_PIXEL points per pixel, however long the selected period is
+    if level is not None:
+        print(f"Plotting from {level}")
+        X_col = df.index
+    for y_col_name in columns:
+        if level is not None:
+            x, y = X_col, df[f"{y_col_name}__mean"]
+        else:
+            x, y = downsample_column(df, y_col_name, AX_DF.bbox.width)
+        if y_col_name in PLOT_LINES:
+            PLOT_LINES[y_col_name].set_data(x, y)
+        else:
+            PLOT_LINES[y_col_name], = AX_DF.plot(x, y, label=y_col_name)
+    # the data limits of the lines, the bands add theirs when they are created
+    AX_DF.relim()
+    if level is not None:
+        for y_col_name in columns:
+            # a band has no set_data, it is replaced
+            if y_col_name in PLOT_BANDS:
+                PLOT_BANDS.pop(y_col_name).remove()
+            PLOT_BANDS[y_col_name] = AX_DF.fill_between(X_col, df[f"{y_col_name}__min"], df[f"{y_col_name}__max"],
+                                                        color=PLOT_LINES[y_col_name].get_color(), alpha=0.2)
+    else:
+        PLOT_DF = df
+
+    # the legend only changes with the selection
+    if list(columns) != PLOT_COLUMNS:
+        PLOT_COLUMNS[:] = columns
+        AX_DF.legend(handles=[PLOT_LINES[col] for col in columns])
+    AX_DF.autoscale_view()
+
+    CANVAS_DF.draw()
+
+@traced()
+def draw_zoomed(columns, level, df, start, end):
+    # The rows of the zoomed range replace the data of the lines and bands, the axes keep the zoomed limits
+    global PLOT_DF, PLOT_LEVEL, PLOT_ZOOM
+    PLOT_LEVEL = level
+    PLOT_DF = df if level is None else None
+    PLOT_ZOOM = (start, end)
+    AX_DF.set_autoscalex_on(False)
+    for col in [col for col in PLOT_BANDS if level is None]:
+        PLOT_BANDS.pop(col).remove()
+    for col in columns:
+        if level is None:
+            PLOT_LINES[col].set_data(*downsample_column(df, col, AX_DF.bbox.width, AX_DF.get_xlim()))
+            continue
+        PLOT_LINES[col].set_data(df.index, df[f"{col}__mean"])
+        if col in PLOT_BANDS:
+            PLOT_BANDS.pop(col).remove()
+        PLOT_BANDS[col] = AX_DF.fill_between(df.index, df[f"{col}__min"], df[f"{col}__max"],
+                                             color=PLOT_LINES[col].get_color(), alpha=0.2)
+    CANVAS_DF.draw_idle()
+
+@traced()
 def show_figure():
-    global DF, AX_DF, CANVAS_DF, DF_Y_COLS
-
     try:
-        # clear the plot
-        AX_DF.clear()
-
-        # get the data between START and END
-        df = DF.loc[START:END]
-
-        # get X and Y data
-        X_col = pd.to_datetime(df.index)
-
-        for y_col_name in DF_Y_COLS:
-            y = df[y_col_name]
-            AX_DF.plot(X_col, y, label=y_col_name)
-
-        # add legend, xlabel, ylabel and title
-        AX_DF.legend()
-        AX_DF.set_xlabel('Datetime')
-        AX_DF.set_ylabel('Y')
-        AX_DF.set_title('Demo plot')
-
-        # rotate x ticks
-        for tick in AX_DF.get_xticklabels():
-            tick.set_rotation(20)
-
-        CANVAS_DF.get_tk_widget().grid(row=2, column=0, columnspan=5)
-        CANVAS_DF.draw()
+        draw_figure(DF_Y_COLS, *get_figure_data(DF_Y_COLS, START, END, AX_DF.bbox.width))
     except Exception as e:
         print(f"Error: {e}")
 
+@traced()
+def get_corr_data(columns, start, end):
+    QUERY_CACHE.check_hash(get_dataset_hash())
+    return QUERY_CACHE.get(('corr', tuple(columns), start, end), lambda: compute_corr(columns, start, end))
+
+def compute_corr(columns, start, end):
+    # the correlation matrix of the selected dates, runs on the worker thread. The index does not have the lazy columns
+    if CORR_INDEX is not None and all(col in CORR_INDEX.columns for col in columns):
+        return CORR_INDEX.corr(columns, start, end, get_frame)
+    if LAZY is not None:
+        return LAZY.corr(columns, start, end)
+    return CORR_DF.loc[columns, columns]
+
+def on_corr_draw(event):
+    # The correlation image is animated, it is left out of the full draws of the canvas. After each of them the background
+    # is saved and the image drawn on top, so an update of the same columns only redraws the image
+    global CORR_BACKGROUND
+    # savefig to svg or pdf draws with a canvas that can't blit
+    if CORR_IMAGE is None or CORR_IMAGE.axes is not AX_CORR or not hasattr(event.canvas, 'copy_from_bbox'):
+        return
+    CORR_BACKGROUND = CANVAS_CORR.copy_from_bbox(AX_CORR.bbox)
+    AX_CORR.draw_artist(CORR_IMAGE)
+    CANVAS_CORR.blit(AX_CORR.bbox)
+
+@traced()
+def draw_corr_matrix(corr_df):
+    global COLORBAR_CORR, CORR_IMAGE, CORR_CANVAS_ID
+    # same columns: the image gets the new values in place and is blitted on the saved background
+    if (INCREMENTAL_RENDERING and CORR_IMAGE is not None and CORR_IMAGE.axes is AX_CORR and CORR_BACKGROUND is not None
+            and list(corr_df.columns) == CORR_LABELS):
+        CORR_IMAGE.set_data(corr_df.to_numpy(dtype='float64'))
+        CANVAS_CORR.restore_region(CORR_BACKGROUND)
+        AX_CORR.draw_artist(CORR_IMAGE)
+        CANVAS_CORR.blit(AX_CORR.bbox)
+        return
+
+    AX_CORR.clear()
+
+    # plot the correlation matrix
+    cax = AX_CORR.matshow(corr_df, cmap='coolwarm', vmin=-1, vmax=1)
+
+    # set x and y ticks
+    AX_CORR.set_xticks(np.arange(len(corr_df.columns)))
+    AX_CORR.set_yticks(np.arange(len(corr_df.index)))
+    AX_CORR.set_xticklabels(corr_df.columns, rotation=90)
+    AX_CORR.set_yticklabels(corr_df.index)
+
+    # add colorbar
+    if 'COLORBAR_CORR' not in globals():
+        COLORBAR_CORR = FIG_CORR.colorbar(cax)
+    else:
+        COLORBAR_CORR.update_normal(cax)
+
+    AX_CORR.set_title('Correlation matrix')
+
+    CORR_IMAGE = cax
+    CORR_LABELS[:] = corr_df.columns
+    if INCREMENTAL_RENDERING:
+        cax.set_animated(True)
+        if CORR_CANVAS_ID is None or CORR_CANVAS_ID[0] is not CANVAS_CORR:
+            CORR_CANVAS_ID = (CANVAS_CORR, CANVAS_CORR.mpl_connect('draw_event', on_corr_draw))
+
+    CANVAS_CORR.draw()
+
+@traced()
 def show_corr_matrix():
-    global CORR_DF, AX_CORR, FIG_CORR, CANVAS_CORR, DF_Y_COLS, COLORBAR_CORR
     try:
-        # get the correlation matrix
-        corr_df = CORR_DF.loc[DF_Y_COLS, DF_Y_COLS]
-
-        AX_CORR.clear()
-
-        # plot the correlation matrix
-        cax = AX_CORR.matshow(corr_df, cmap='coolwarm', vmin=-1, vmax=1)
-
-        # set x and y ticks
-        AX_CORR.set_xticks(np.arange(len(corr_df.columns)))
-        AX_CORR.set_yticks(np.arange(len(corr_df.index)))
-        AX_CORR.set_xticklabels(corr_df.columns, rotation=90)
-        AX_CORR.set_yticklabels(corr_df.index)
-
-        # add colorbar
-        if 'COLORBAR_CORR' not in globals():
-            COLORBAR_CORR = FIG_CORR.colorbar(cax)
-        else:
-            COLORBAR_CORR.update_normal(cax)
-        
-        AX_CORR.set_title('Correlation matrix')
-
-        CANVAS_CORR.get_tk_widget().grid(row=2, column=7, columnspan=5)
-        CANVAS_CORR.draw()
-        
+        draw_corr_matrix(get_corr_data(DF_Y_COLS, START, END))
     except Exception as e:
         print(f"Error: {e}")
 
 
-def update_figure(update_date):
-    global DF_Y_COUNTRIES, DF_Y_TYPES, DF_Y_COLS
+def update_figure(root, update_date):
+    global DF_Y_COUNTRIES, DF_Y_TYPES, DF_Y_COLS, REQUEST_ID
 
     # get selected dates
     update_date()
@@ -266,55 +591,225 @@ def update_figure(update_date):
     DF_Y_COLS = get_col_names(DF_Y_COUNTRIES, DF_Y_TYPES)
     print(f"Selected columns: {DF_Y_COLS}")
 
-    # update the main plot
-    show_figure()
-
-    # update the correlation matrix
-    show_corr_matrix()
+    # the live plot only changes its columns
+    if LIVE_RUNNING:
+        draw_live()
+        return
+
+    # the data is read on the worker thread, the plots are drawn when it is ready
+    # a newer update makes the result of the older one obsolete, it is not drawn
+    REQUEST_ID += 1
+    request_id = REQUEST_ID
+    columns, start, end, width = list(DF_Y_COLS), START, END, AX_DF.bbox.width
+
+    def work():
+        return get_figure_data(columns, start, end, width), get_corr_data(columns, start, end)
+
+    def done(result):
+        if request_id != REQUEST_ID:
+            return
+        figure_data, corr_df = result
+        print(f"Query cache: {QUERY_CACHE.stats()}")
+        draw_figure(columns, *figure_data)
+        draw_corr_matrix(corr_df)
+
+    run_in_background(root, "Loading plot...", work, done)
+
+def get_live_client():
+    add_collection_path()
+    if LIVE_TRANSPORT == 'fake':
+        from fake_client import FakeEntsoePandasClient
+        return FakeEntsoePandasClient()
+    from entsoe import EntsoePandasClient
+    return EntsoePandasClient(os.environ.get('ENTSOE_API_KEY'))
+
+@traced()
+def start_live(countries, last_date):
+    # Runs on the worker thread. The windows start with the saved prices they need, so the derived values
+    # of the first live prices are the same as the processing would give
+    global LIVE_CLIENT, LIVE_CLOCK
+    from process_data import get_lookback
+
+    prices = get_frame(countries, pd.Timestamp(last_date) - pd.Timedelta(hours=get_lookback()), None)
+    for country in countries:
+        LIVE[country] = LiveSeries(country, LIVE_CAPACITY)
+        LIVE[country].extend(prices[country])
+    LIVE_CLIENT = get_live_client()
+    LIVE_CLOCK = max(series.last_time for series in LIVE.values()) + pd.Timedelta(hours=1)
+
+def get_live_range():
+    # (start, end) of the next poll, from the hour after the last saved price
+    global LIVE_CLOCK
+    start = min(series.last_time for series in LIVE.values()) + pd.Timedelta(hours=1)
+    if LIVE_TRANSPORT == 'fake':
+        LIVE_CLOCK += pd.Timedelta(hours=LIVE_HOURS_PER_POLL)
+        return start, LIVE_CLOCK
+    # the day-ahead prices of tomorrow are published around noon
+    return start, pd.Timestamp.now(tz='UTC').tz_localize(None).floor('D') + pd.Timedelta(days=2)
+
+@traced()
+def poll_prices(countries, start, end):
+    # The new prices of every country, runs on the worker thread. A failed country is asked again at the next poll
+    prices = {}
+    for country in countries:
+        try:
+            prices[country] = LIVE_CLIENT.query_day_ahead_prices(country, start=start.tz_localize('UTC'), end=end.tz_localize('UTC'))
+        except Exception as e:
+            print(f"Error: {e}")
+    return prices
+
+@traced()
+def add_live_prices(prices):
+    # The derived columns are updated for every new price, the prices already in the buffers are skipped
+    return sum(LIVE[country].extend(series) for country, series in prices.items())
+
+def get_live_frame(columns):
+    # The rows of the live buffers of the given columns, indexed by Datetime
+    countries = [country for country in dict.fromkeys(col[:2] for col in columns) if country in LIVE]
+    if not countries:
+        return pd.DataFrame()
+    df = pd.concat([LIVE[country].frame() for country in countries], axis=1)
+    return df[[col for col in columns if col in df.columns]]
+
+def draw_live():
+    global DF_Y_COLS
+    DF_Y_COLS = get_col_names(DF_Y_COUNTRIES, DF_Y_TYPES)
+    df = get_live_frame(DF_Y_COLS)
+    if len(df.columns) > 0:
+        draw_figure(list(df.columns), None, df)
+        set_status(f"Live, last price at {df.index[-1]}")
+
+def poll_live(root):
+    # The next poll is scheduled when the last one is done, so the polls don't pile up on a slow feed
+    if not LIVE_RUNNING:
+        return
+    countries = list(LIVE)
+    start, end = get_live_range()
+
+    def done(prices):
+        if not LIVE_RUNNING:
+            return
+        root.after(LIVE_POLL_MS, lambda: poll_live(root))
+        if add_live_prices(prices):
+            draw_live()
+
+    run_in_background(root, "Polling prices...", lambda: poll_prices(countries, start, end), done)
+
+def toggle_live(root, button, last_date):
+    global LIVE_RUNNING
+    LIVE_RUNNING = not LIVE_RUNNING
+    button.config(text="Stop live" if LIVE_RUNNING else "Live")
+    if not LIVE_RUNNING:
+        return
+    if LIVE:
+        poll_live(root)
+        return
+    countries = get_2char_columns(DF_COLUMNS)
+    run_in_background(root, "Loading live prices...", lambda: start_live(countries, last_date), lambda _: poll_live(root))
+
+def get_date_range():
+    # First and last date of an output without a catalog
+    if PARQUET_FOLDER is None:
+        with get_engine(SQLITE_FILE).connect() as conn:
+            first, last = conn.execute(text('SELECT MIN("ts"), MAX("ts") FROM "df"')).fetchone()
+        return pd.Timestamp(first, unit='s'), pd.Timestamp(last, unit='s')
+    index = read_table('df', columns=[]).index
+    return index[0], index[-1]
+
+def load_data(catalog):
+    # Everything that is not needed to open the window, runs on the worker thread
+    global CORR_DF, LAZY, CORR_INDEX
+    if PARQUET_FOLDER is not None:
+        CORR_DF = read_parquet(os.path.join(PARQUET_FOLDER, 'corr'))
+        for table, _ in PYRAMID_LEVELS:
+            if os.path.isdir(os.path.join(PARQUET_FOLDER, table)):
+                LEVEL_COLUMNS[table] = set(get_parquet_columns(os.path.join(PARQUET_FOLDER, table)))
+    else:
+        engine = get_engine(SQLITE_FILE)
+        table_names = get_table_names(engine)
+        CORR_DF = get_data(engine, 'corr')
+        CORR_DF.set_index('index', inplace=True)
+        for table, _ in PYRAMID_LEVELS:
+            if table in table_names:
+                LEVEL_COLUMNS[table] = set(get_sqlite_columns(engine, table))
+
+    if catalog is not None and catalog.get('lazy'):
+        LAZY = get_lazy_metrics(read_table('df', columns=list(catalog['countries'])), catalog)
+
+    CORR_INDEX = get_corr_index(PARQUET_FOLDER or SQLITE_FILE)
+
+def load_metadata():
+    # The output, its columns and its first and last date, the catalog is returned when there is one
+    global DF_COLUMNS, PARQUET_FOLDER, SQLITE_FILE
+    filename = get_out_filename()
 
+    if STORAGE_BACKEND == 'parquet':
+        PARQUET_FOLDER = get_parquet_folder(filename)
+    else:
+        SQLITE_FILE = filename
+
+    # the columns and the dates come from the catalog when there is one
+    catalog = read_catalog(PARQUET_FOLDER or filename)
+    if catalog is not None:
+        SAVED_DTYPES.update(catalog.get('dtypes', {}))
+        DF_COLUMNS = [col for col in catalog['columns'] if col != 'Datetime']
+        first_date = pd.Timestamp(catalog['first'])
+        last_date = pd.Timestamp(catalog['last'])
+    else:
+        if PARQUET_FOLDER is not None:
+            DF_COLUMNS = get_parquet_columns(os.path.join(PARQUET_FOLDER, 'df'))
+        else:
+            DF_COLUMNS = get_sqlite_columns(get_engine(filename), 'df')
+        first_date, last_date = get_date_range()
+    return catalog, first_date, last_date
 
 def main():
-    global DF, CORR_DF, AX_DF, FIG_CORR, CANVAS_DF, AX_CORR, FIG_CORR, CANVAS_CORR, DF_Y_COLS
-    #read in the data
-    filename = get_out_filename()
-    engine = get_engine(filename)
-    table_names = get_table_names(engine)
-
-    # read in the dataframes
-    dfs = read_in_dfs(engine, table_names)
-    DF = dfs['df']
-    CORR_DF = dfs['corr']
-    CORR_DF.set_index('index', inplace=True)
+    global AX_DF, FIG_CORR, CANVAS_DF, AX_CORR, CANVAS_CORR, WORKER, STATUS, ROOT
 
-    # set index to datetime in df
-    DF['Datetime'] = pd.to_datetime(DF['Datetime'])
-    DF.set_index('Datetime', inplace=True)
+    # only the metadata is read before the window opens, it fills the listboxes and the dates
+    catalog, first_date, last_date = load_metadata()
 
     # create the GUI
     root = create_ui()
+    ROOT = root
 
     # create a plot
     fig_df, AX_DF = create_figure()
     FIG_CORR, AX_CORR = create_figure()
     CANVAS_DF = FigureCanvasTkAgg(fig_df, master=root)
     CANVAS_CORR = FigureCanvasTkAgg(FIG_CORR, master=root)
-    update_date = date_picker(root, init_start=DF.index[0], init_end=DF.index[-1])
-    show_figure()
-    show_corr_matrix()
+    update_date = date_picker(root, init_start=first_date, init_end=last_date)
+    CANVAS_DF.get_tk_widget().grid(row=2, column=0, columnspan=5)
+    CANVAS_CORR.get_tk_widget().grid(row=2, column=7, columnspan=5)
 
-    #button to update the plot
-    update_button = tk.Button(root, text="Update Plot", command=lambda: update_figure(update_date))
+    # zooming in with the toolbar shows the hourly points of the zoomed range
+    toolbar = NavigationToolbar2Tk(CANVAS_DF, root, pack_toolbar=False)
+    toolbar.grid(row=3, column=0, columnspan=5)
+
+    #button to update the plot, enabled when the data is loaded
+    update_button = tk.Button(root, text="Update Plot", command=lambda: update_figure(root, update_date), state=tk.DISABLED)
     update_button.grid(row=0, column=6, columnspan=2)
+
+    # the plot follows the new prices of the feed until the button is pressed again
+    live_button = tk.Button(root, text="Live", state=tk.DISABLED)
+    live_button.config(command=lambda: toggle_live(root, live_button, last_date))
+    live_button.grid(row=1, column=6, columnspan=2)
     
     # a label nex to the button
-    firs_date = DF.index[0]
-    last_date = DF.index[-1]
-    info_label = tk.Label(root, text="First date: " + str(firs_date) + " Last date: " + str(last_date))
+    info_label = tk.Label(root, text="First date: " + str(first_date) + " Last date: " + str(last_date))
     info_label.grid(row=0, column=7, columnspan=5)
 
+    # the rest of the data is loaded in the background
+    STATUS = create_status(root)
+    WORKER = ThreadPoolExecutor(max_workers=1)
+    run_in_background(root, "Loading data...", lambda: load_data(catalog),
+                      lambda _: [button.config(state=tk.NORMAL) for button in (update_button, live_button)])
+
     #run the GUI
-    root.mainloop()
+    try:
+        root.mainloop()
+    finally:
+        WORKER.shutdown(wait=False, cancel_futures=True)
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,157 @@
+import os
+import sys
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import app
+
+# Run from any folder: python ui/export.py [spec.json]
+# Saves the plots of the app without a display: one plot for every country, column type and date range,
+# and one correlation matrix for every country and date range. The data of every date range is read once,
+# before the workers start, and the workers get it when they start instead of reading it for every plot.
+
+# Global variables
+
+# countries and types: None = all of the output, ranges: [start, end] pairs, None = the whole output
+# format: png, svg or pdf
+SPEC = {'countries': None, 'types': None, 'ranges': None, 'format': 'png', 'corr': True}
+EXPORT_FOLDER = 'exports' # In the ui folder
+EXPORT_WORKERS = os.cpu_count() or 1 # Number of worker processes (1 = render in this process)
+FIGURE_SIZE = (10, 6) # Inches
+DPI = 100
+
+RANGE_DATA = {} # (start, end): (aggregated table or None, rows of every exported column)
+CORR_DATA = {} # (start, end): correlation matrix of every exported column
+
+# Helper functions
+
+class ExportCanvas(FigureCanvasAgg):
+    # savefig renders the figure itself, the draws of draw_figure and draw_corr_matrix would only be repeated by it
+    def draw(self):
+        pass
+
+def read_spec(filename=None):
+    spec = dict(SPEC)
+    if filename is not None:
+        with open(filename) as f:
+            spec.update(json.load(f))
+    if spec['format'] not in ('png', 'svg', 'pdf'):
+        raise ValueError(f"Unknown format: {spec['format']}")
+    return spec
+
+def get_ranges(spec, first_date, last_date):
+    if not spec['ranges']:
+        return [(first_date, last_date)]
+    return [(pd.Timestamp(start), pd.Timestamp(end)) for start, end in spec['ranges']]
+
+def get_name(*parts, start, end, fmt):
+    return '_'.join(list(parts) + [f"{start:%Y%m%d}-{end:%Y%m%d}"]) + f".{fmt}"
+
+def get_jobs(spec, countries, types, ranges):
+    # (kind, columns, start, end, title, filename) of every plot
+    jobs = []
+    for start, end in ranges:
+        for country in countries:
+            for col_type in types:
+                jobs.append(('figure', app.get_col_names([country], [col_type]), start, end,
+                             f"{country} {col_type} {start:%Y-%m-%d} - {end:%Y-%m-%d}", get_name(country, col_type, start=start, end=end, fmt=spec['format'])))
+            if spec['corr']:
+                jobs.append(('corr', app.get_col_names([country], types), start, end,
+                             f"Correlation matrix {country} {start:%Y-%m-%d} - {end:%Y-%m-%d}", get_name('corr', country, start=start, end=end, fmt=spec['format'])))
+    return jobs
+
+def create_figure(**margins):
+    # Fixed margins with room for the rotated dates and the column names, cheaper than a tight bounding box for every plot
+    fig = Figure(figsize=FIGURE_SIZE, dpi=DPI)
+    fig.subplots_adjust(**margins)
+    return fig, fig.add_subplot(111)
+
+def create_plot_figure():
+    return create_figure(bottom=0.15)
+
+def create_corr_figure():
+    return create_figure(left=0.25, top=0.65)
+
+def get_plot_width():
+    # Width of the plot area in pixels, it chooses the aggregated table like in the app
+    return create_plot_figure()[1].bbox.width
+
+def load_ranges(columns, ranges, corr):
+    # Rows and correlation matrices of every date range, with the app's own functions
+    width = get_plot_width()
+    for start, end in ranges:
+        RANGE_DATA[(start, end)] = app.get_figure_data(columns, start, end, width)
+        if corr:
+            CORR_DATA[(start, end)] = app.get_corr_data(columns, start, end)
+
+# Workers
+
+def init_worker(range_data, corr_data):
+    # Runs once in every worker, the figures are reused for all of its plots
+    global RANGE_DATA, CORR_DATA
+    RANGE_DATA, CORR_DATA = range_data, corr_data
+    app.FIG_DF, app.AX_DF = create_plot_figure()
+    app.CANVAS_DF = ExportCanvas(app.FIG_DF)
+    app.FIG_CORR, app.AX_CORR = create_corr_figure()
+    app.CANVAS_CORR = ExportCanvas(app.FIG_CORR)
+
+def render(job, folder):
+    kind, columns, start, end, title, name = job
+    if kind == 'figure':
+        level, df = RANGE_DATA[(start, end)]
+        # new axes for every plot, the lines get the colours of the columns' order and not of the previous job
+        app.reset_figure()
+        app.draw_figure(columns, level, df)
+        app.AX_DF.set_title(title)
+        fig = app.FIG_DF
+    else:
+        corr_df = CORR_DATA[(start, end)].loc[columns, columns]
+        app.draw_corr_matrix(corr_df)
+        app.AX_CORR.set_title(title)
+        fig = app.FIG_CORR
+    filename = os.path.join(folder, name)
+    fig.savefig(filename)
+    return filename
+
+def render_all(jobs, folder, workers=None):
+    workers = workers or EXPORT_WORKERS
+    if workers <= 1:
+        init_worker(RANGE_DATA, CORR_DATA)
+        return [render(job, folder) for job in jobs]
+    # jobs are sent in batches, the figures of a worker are created once for all of its plots
+    chunksize = max(1, len(jobs) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(RANGE_DATA, CORR_DATA)) as pool:
+        return list(pool.map(render, jobs, [folder] * len(jobs), chunksize=chunksize))
+
+# Main code
+
+def main(spec_filename=None):
+    spec = read_spec(spec_filename)
+    catalog, first_date, last_date = app.load_metadata()
+    app.load_data(catalog)
+
+    countries = spec['countries'] or app.get_2char_columns(app.DF_COLUMNS)
+    types = spec['types'] or sorted(app.unique_col_types(app.DF_COLUMNS, countries))
+    ranges = get_ranges(spec, first_date, last_date)
+    jobs = get_jobs(spec, countries, types, ranges)
+
+    start_time = time.perf_counter()
+    load_ranges(app.get_col_names(countries, types), ranges, spec['corr'])
+    print(f"Read {len(ranges)} date ranges in {time.perf_counter() - start_time:.2f} s")
+
+    folder = app.get_path('ui', EXPORT_FOLDER)
+    os.makedirs(folder, exist_ok=True)
+    start_time = time.perf_counter()
+    filenames = render_all(jobs, folder)
+    seconds = time.perf_counter() - start_time
+    print(f"Saved {len(filenames)} plots in {folder} in {seconds:.2f} s ({len(filenames) / seconds:.1f} plots/s, {EXPORT_WORKERS} workers)")
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
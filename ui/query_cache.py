@@ -0,0 +1,59 @@
+import sys
+from collections import OrderedDict
+
+# Least recently used cache of the frames the app reads for the plots and the correlation matrix
+
+def get_nbytes(value):
+    # Memory of a frame, a series or a tuple of them
+    if hasattr(value, 'memory_usage'):
+        memory = value.memory_usage(index=True, deep=True)
+        return int(memory.sum() if hasattr(memory, 'sum') else memory)
+    if isinstance(value, (tuple, list)):
+        return sum(get_nbytes(item) for item in value)
+    return sys.getsizeof(value)
+
+class QueryCache:
+    def __init__(self, max_bytes=128 * 2**20):
+        self.max_bytes = max_bytes # Least recently used results are dropped above this size
+        self.items = OrderedDict() # key: (value, bytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.dataset_hash = None # The results belong to this version of the dataset
+
+    def __repr__(self):
+        return f"QueryCache({len(self.items)} results, {self.nbytes} bytes)"
+
+    def check_hash(self, dataset_hash):
+        # A changed dataset makes every result obsolete
+        if dataset_hash != self.dataset_hash:
+            self.clear()
+            self.dataset_hash = dataset_hash
+
+    def clear(self):
+        self.items.clear()
+        self.nbytes = 0
+
+    def get(self, key, compute):
+        # The cached result of key, compute() is called on a miss
+        if key in self.items:
+            self.items.move_to_end(key)
+            self.hits += 1
+            return self.items[key][0]
+
+        self.misses += 1
+        value = compute()
+        nbytes = get_nbytes(value)
+        if nbytes <= self.max_bytes:
+            self.items[key] = (value, nbytes)
+            self.nbytes += nbytes
+            self.evict()
+        return value
+
+    def evict(self):
+        while self.nbytes > self.max_bytes:
+            _, (_, nbytes) = self.items.popitem(last=False)
+            self.nbytes -= nbytes
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'results': len(self.items), 'bytes': self.nbytes}